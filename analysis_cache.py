@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+
+
+class AnalysisCache:
+    # On-disk cache of code analyses, keyed by a SHA-256 of everything that shapes the reply
+    # (model, prompt template, language and file content), so re-uploading unchanged files
+    # skips the Claude call. Entries live at analysis_cache/ab/abcdef....json; a hit bumps
+    # the entry's mtime, so eviction drops entries past MAX_AGE_SECONDS first and then the
+    # least recently used ones until the cache fits in MAX_BYTES.
+
+    MAX_BYTES = 50 * 1024 * 1024
+    MAX_AGE_SECONDS = 30 * 24 * 3600
+
+    def __init__(self, root, max_bytes=None, max_age_seconds=None):
+        self.root = Path(root)
+        self.root.mkdir(exist_ok=True)
+        self.max_bytes = max_bytes or self.MAX_BYTES
+        self.max_age_seconds = max_age_seconds or self.MAX_AGE_SECONDS
+        self._size = None
+        self._lock = threading.Lock()
+
+    def key(self, content, language, model, template):
+        digest = hashlib.sha256()
+        for part in (model, template, language, content):
+            digest.update(part.encode('utf-8'))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            if time.time() - path.stat().st_mtime > self.max_age_seconds:
+                self._remove(path)
+                raise FileNotFoundError(path)
+            with open(path, 'r', encoding='utf-8') as f:
+                analysis = json.load(f)["analysis"]
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            return None
+        return analysis
+
+    def put(self, key, analysis):
+        path = self.path(key)
+        path.parent.mkdir(exist_ok=True)
+        data = json.dumps({"analysis": analysis, "created_at": time.time()}).encode('utf-8')
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        previous = path.stat().st_size if path.exists() else 0
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self._size is not None:
+                self._size += len(data) - previous
+            over_budget = self._size is None or self._size > self.max_bytes
+        if over_budget:
+            self.prune()
+
+    def prune(self):
+        # Drops expired entries, then the least recently used ones, until the cache fits.
+        # Returns the number of entries removed.
+        now = time.time()
+        entries = []
+        removed = 0
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if not entry.name.endswith(".json"):
+                    continue
+                stat = entry.stat()
+                if now - stat.st_mtime > self.max_age_seconds:
+                    removed += self._remove(Path(entry.path))
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        size = sum(entry_size for _, entry_size, _ in entries)
+        entries.sort()
+        for _, entry_size, entry_path in entries:
+            if size <= self.max_bytes:
+                break
+            removed += self._remove(Path(entry_path))
+            size -= entry_size
+
+        with self._lock:
+            self._size = size
+        return removed
+
+    def path(self, key):
+        return self.root / key[:2] / f"{key}.json"
+
+    def _remove(self, path):
+        try:
+            path.unlink()
+            return 1
+        except FileNotFoundError:
+            return 0
@@ -0,0 +1,105 @@
+import re
+import sqlite3
+from pathlib import Path
+
+from storage import SQLiteDatabase
+
+
+class AnalysisLog(SQLiteDatabase):
+    # One row per code analysis, in SQLite so past analyses can be looked up by file name or
+    # content hash instead of grepping a text file. Replaces file_analysis_log.txt, which
+    # import_text_log reads in once.
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS analyses (
+            id INTEGER PRIMARY KEY,
+            created_at TEXT NOT NULL,
+            file_name TEXT NOT NULL,
+            language TEXT,
+            content_hash TEXT,
+            model TEXT,
+            latency_ms INTEGER,
+            tokens_in INTEGER NOT NULL DEFAULT 0,
+            tokens_out INTEGER NOT NULL DEFAULT 0,
+            cached INTEGER NOT NULL DEFAULT 0,
+            analysis TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_analyses_file_name ON analyses (file_name, created_at);
+        CREATE INDEX IF NOT EXISTS idx_analyses_content_hash ON analyses (content_hash, created_at);
+    """
+    COLUMNS = ("created_at", "file_name", "language", "content_hash", "model", "latency_ms",
+               "tokens_in", "tokens_out", "cached", "analysis")
+
+    # Skips failed analyses logged before they were kept out of the log
+    SUCCEEDED = "analysis NOT LIKE 'Analysis error:%'"
+
+    # Entry header written by the old text log
+    TEXT_LOG_ENTRY = re.compile(r'^\[([^\]]+)\] File: (.*), Language: (.*)\nAnalysis:\n', re.MULTILINE)
+
+    ROW_FACTORY = sqlite3.Row
+
+    def __init__(self, db_path):
+        super().__init__(db_path)
+        self._connect().executescript(self.SCHEMA)
+
+    def record(self, entries):
+        # entries are dicts keyed by COLUMNS; missing fields are stored as NULL/0
+        rows = [tuple(entry.get(column) if column not in ("tokens_in", "tokens_out", "cached")
+                      else int(entry.get(column) or 0) for column in self.COLUMNS)
+                for entry in entries]
+        if not rows:
+            return
+        with self._transaction() as conn:
+            conn.executemany(
+                f"INSERT INTO analyses ({', '.join(self.COLUMNS)}) VALUES ({', '.join('?' * len(self.COLUMNS))})",
+                rows
+            )
+
+    def latest_for_file(self, file_name):
+        row = self._connect().execute(
+            f"SELECT * FROM analyses WHERE file_name = ? AND {self.SUCCEEDED} ORDER BY created_at DESC, id DESC LIMIT 1",
+            (file_name,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def latest_for_hash(self, content_hash):
+        row = self._connect().execute(
+            f"SELECT * FROM analyses WHERE content_hash = ? AND {self.SUCCEEDED} ORDER BY created_at DESC, id DESC LIMIT 1",
+            (content_hash,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def history(self, file_name, limit=20):
+        rows = self._connect().execute(
+            "SELECT * FROM analyses WHERE file_name = ? ORDER BY created_at DESC, id DESC LIMIT ?", (file_name, limit)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def recent(self, limit=20):
+        rows = self._connect().execute(
+            "SELECT * FROM analyses ORDER BY created_at DESC, id DESC LIMIT ?", (limit,)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def import_text_log(self, log_path):
+        # Parses file_analysis_log.txt entries into rows. The text log has no hash, model,
+        # latency or token data, so those stay empty. Entries already imported (same
+        # timestamp and file name) are skipped, so running it twice is harmless.
+        text = Path(log_path).read_text(encoding="utf-8")
+        headers = list(self.TEXT_LOG_ENTRY.finditer(text))
+        conn = self._connect()
+        entries = []
+        for n, header in enumerate(headers):
+            end = headers[n + 1].start() if n + 1 < len(headers) else len(text)
+            created_at, file_name, language = header.groups()
+            if conn.execute("SELECT 1 FROM analyses WHERE file_name = ? AND created_at = ?",
+                            (file_name, created_at)).fetchone():
+                continue
+            entries.append({
+                "created_at": created_at,
+                "file_name": file_name,
+                "language": language,
+                "analysis": text[header.end():end].strip()
+            })
+        self.record(entries)
+        return len(entries)
@@ -1,29 +1,50 @@
 import base64
-import io
-import os
-from io import BytesIO
 
-import pyperclip
-import streamlit as st
-from PIL import Image
+from startup_timing import format_startup_report, timed
 
-from chat_manager import ChatHistoryManager
+with timed("import streamlit"):
+    import streamlit as st
+
+with timed("import chat_manager"):
+    from chat_manager import get_manager
+
+import background_assets
+
+# pyperclip and PIL are imported where they are used, so they only load when a file is
+# uploaded or the clipboard is pasted
+
+
+# Messages rendered at first, and added each time "Load earlier messages" is pressed
+MESSAGE_WINDOW = 50
+
+
+# The background listing and CSS survive reruns; the directory's mtime and the file's size and
+# mtime are part of the keys, so adding or replacing an image is picked up on the next rerun
+@st.cache_data(show_spinner=False)
+def cached_background_list(directory_mtime_ns):
+    return background_assets.list_backgrounds()
+
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def cached_background_css(source_key):
+    return background_assets.background_css(source_key[0])
 
 
 def handle_multiple_files(files, manager):
+    with timed("import PIL"):
+        from PIL import Image
+
     stored_files = []
 
     for file in files:
         try:
             if file.type.startswith('image'):
                 image = Image.open(file)
-                buffered = io.BytesIO()
-                image.save(buffered, format=image.format)
-                image_data = base64.b64encode(buffered.getvalue()).decode()
+                image_ref = manager.store_image(file.getvalue(), Image.MIME.get(image.format, "image/png"))
                 stored_files.append({
                     'name': file.name,
                     'type': 'image',
-                    'content': image_data,
+                    'image_ref': image_ref,
                     'format': image.format,
                     'language': 'image'
                 })
@@ -61,7 +82,7 @@ def main():
             else:
                 st.session_state[key] = "Claude"
 
-    manager = ChatHistoryManager()
+    manager = get_manager()
     st.title("RonnieRome Virtual Board Room - GameDev")
 
     st.markdown("""
@@ -244,23 +265,15 @@ def main():
             """
     }
 
-    BACKGROUND_DIR = "backgrounds"
-
     # Ensure the directory exists
-    if not os.path.exists(BACKGROUND_DIR):
-        os.makedirs(BACKGROUND_DIR)
+    background_assets.BACKGROUND_DIR.mkdir(exist_ok=True)
 
-    background_images = [f for f in os.listdir(BACKGROUND_DIR) if f.endswith((".jpg", ".jpeg", ".png"))]
+    background_images = cached_background_list(background_assets.BACKGROUND_DIR.stat().st_mtime_ns)
 
     if not background_images:
         st.warning("No background images found in the 'backgrounds' folder. Please add some images.")
         background_images = ["None"]
 
-    # Function to encode the selected image to base64
-    def get_base64_image(image_path):
-        with open(image_path, "rb") as img_file:
-            return base64.b64encode(img_file.read()).decode()
-
     # Create two columns with equal width
     col1, col2 = st.columns(2)
 
@@ -279,8 +292,10 @@ def main():
 
     # Apply the selected background using custom CSS
     if selected_bg != "None":
-        bg_path = os.path.join(BACKGROUND_DIR, selected_bg)
-        bg_base64 = get_base64_image(bg_path)
+        try:
+            st.markdown(cached_background_css(background_assets.source_key(selected_bg)), unsafe_allow_html=True)
+        except Exception as e:
+            print(f"Background error: {str(e)}")
         st.markdown("""
             <style>
             /* Apply clean fonts to main chat */
@@ -342,21 +357,46 @@ def main():
         with col2:
             paste_button = st.button("📎 Paste Scr")
 
+        # Earlier analyses of the selected files come from the analysis log, without a Claude call
+        previous = []
+        for file in uploaded_files or []:
+            if not file.type.startswith('image'):
+                try:
+                    record = manager.previous_analysis(file.name, file.getvalue().decode('utf-8'))
+                except Exception as e:
+                    print(f"Analysis log error: {str(e)}")
+                    record = None
+                if record:
+                    previous.append(record)
+        if previous:
+            with st.expander(f"Previous analyses ({len(previous)})"):
+                for record in previous:
+                    status = "unchanged" if record['unchanged'] else "file has changed since"
+                    st.markdown(f"**{record['file_name']}** — {record['created_at'][:19]} ({status})\n\n"
+                                f"{record['analysis']}")
+
         if paste_button:
             try:
+                with timed("import pyperclip"):
+                    import pyperclip
                 clipboard_data = pyperclip.paste()
+                img_bytes = None
                 if clipboard_data.startswith('data:image'):
-                    img_data = clipboard_data.split(',')[1]
-                    img_bytes = BytesIO(base64.b64decode(img_data))
-                    st.image(img_bytes, use_container_width=True)
-                    st.session_state.clipboard_image = img_data
+                    header, img_data = clipboard_data.split(',', 1)
+                    img_bytes = base64.b64decode(img_data)
+                    mime = header[len('data:'):].split(';')[0]
                 elif clipboard_data.lower().endswith(('.png', '.jpg', '.jpeg')):
                     with open(clipboard_data, 'rb') as file:
                         img_bytes = file.read()
+                    mime = "image/png" if clipboard_data.lower().endswith('.png') else "image/jpeg"
+                if img_bytes is not None:
                     st.image(img_bytes, use_container_width=True)
-                    st.session_state.clipboard_image = base64.b64encode(img_bytes).decode()
+                    # Pasted images go to the blob store like uploads; the session keeps only the reference
+                    image_ref = manager.store_image(img_bytes, mime)
+                    st.session_state.clipboard_image = image_ref
                     if st.session_state.selected_conv:
-                        manager.add_message(st.session_state.selected_conv, "[Clipboard image pasted]", "user")
+                        manager.add_message(st.session_state.selected_conv, "[Clipboard image pasted]", "user",
+                                            image_ref=image_ref)
             except Exception as e:
                 st.error(f"Clipboard error: {e}")
 
@@ -385,6 +425,31 @@ def main():
                         st.session_state.show_title_input = False
                         st.rerun()
 
+        # Message search; picking a result opens its conversation in the selector below
+        with st.expander("🔍 Search Messages"):
+            search_query = st.text_input("Search", key="search_query", label_visibility="collapsed",
+                                         placeholder="Search all conversations")
+            col1, col2 = st.columns([1, 1])
+            with col1:
+                search_services = {"All services": None, "Claude": "claude", "ChatGPT": "chatgpt",
+                                   "Gemini": "gemini", "DALL-E": "dalle", "Board": "board"}
+                search_service = search_services[st.selectbox("Service", list(search_services), key="search_service")]
+            with col2:
+                search_models = {"All models": None, **{v: k for k, v in {
+                    **manager.CLAUDE_MODELS, **manager.GPT_MODELS, **manager.GEMINI_MODELS, **manager.DALLE_MODELS
+                }.items()}}
+                search_model = search_models[st.selectbox("Model", list(search_models), key="search_model")]
+            if search_query:
+                results = manager.search_messages(search_query, search_service, search_model, limit=20)
+                if not results:
+                    st.caption("No matching messages")
+                for n, result in enumerate(results):
+                    label = f"{result['conv_id']} · #{result['idx'] + 1} ({result['sender']})"
+                    if st.button(label, key=f"search_result_{n}", use_container_width=True):
+                        st.session_state.selected_conv = result['conv_id']
+                        st.session_state.search_target = (result['conv_id'], result['idx'])
+                    st.caption(result['snippet'])
+
         conversations = manager.list_conversations()
         if conversations:
             st.session_state.selected_conv = st.selectbox(
@@ -395,7 +460,8 @@ def main():
             )
 
             if st.session_state.selected_conv:
-                st.session_state.ai_service = st.radio("AI Service", ["Claude", "ChatGPT", "DALL-E", "Gemini"])
+                st.session_state.ai_service = st.radio("AI Service", ["Claude", "ChatGPT", "DALL-E", "Gemini",
+                                                                     "All selected models"])
 
                 if st.session_state.ai_service == "Claude":
                     model = st.selectbox("Model", list(manager.CLAUDE_MODELS.values()))
@@ -407,125 +473,202 @@ def main():
                     model = st.selectbox("Model", list(manager.DALLE_MODELS.values()))
                     model_key = [k for k, v in manager.DALLE_MODELS.items() if v == model][0]
                     size = st.selectbox("Image Size", ["1024x1024", "512x512"])
+                    # DALL-E 3 makes one image per request; DALL-E 2 can return a batch
+                    image_count = st.slider("Images", 1, 4, 1) if model_key == "dall-e-2" else 1
+                elif st.session_state.ai_service == "All selected models":
+                    board_options = {f"Claude · {v}": ("claude", k) for k, v in manager.CLAUDE_MODELS.items()}
+                    board_options.update({f"ChatGPT · {v}": ("chatgpt", k) for k, v in manager.GPT_MODELS.items()})
+                    board_options.update({f"Gemini · {v}": ("gemini", k) for k, v in manager.GEMINI_MODELS.items()})
+                    board_models = st.multiselect("Models", list(board_options),
+                                                  default=["Claude · Sonnet", "ChatGPT · GPT-3.5", "Gemini · Gemini Pro"])
+                    board_targets = [board_options[label] for label in board_models]
                 else:
                     model = st.selectbox("Model", list(manager.GEMINI_MODELS.values()))
                     model_key = [k for k, v in manager.GEMINI_MODELS.items() if v == model][0]
 
+                if st.session_state.ai_service in ("Claude", "ChatGPT", "Gemini"):
+                    stream_replies = st.checkbox("Stream replies", value=True)
+
     # Main content area
     if st.session_state.selected_conv:
-        conversation = manager.get_conversation(st.session_state.selected_conv)
-        st.caption(f"Current Chat: {conversation['title']}")
+        # Title and token totals come from the conversation summary; only the visible window of
+        # messages is loaded
+        summary = manager.get_conversation_summary(st.session_state.selected_conv)
+        if st.session_state.get('window_conv') != st.session_state.selected_conv:
+            st.session_state.window_conv = st.session_state.selected_conv
+            st.session_state.message_window = MESSAGE_WINDOW
+        search_target = st.session_state.pop('search_target', None)
+        if summary and search_target and search_target[0] == st.session_state.selected_conv:
+            # Widen the window so a message picked from search is on screen
+            st.session_state.message_window = max(st.session_state.message_window,
+                                                  summary['message_count'] - search_target[1])
+        st.caption(f"Current Chat: {summary['title'] if summary else st.session_state.selected_conv}")
 
         # Export buttons
         export_col1, export_col2, export_col3, export_col4 = st.columns(4)
         with export_col1:
-            if st.button("Export JSON"):
-                content = manager.export_conversation(st.session_state.selected_conv, "json")
-                if content:
-                    st.download_button("Download JSON", content, f"{st.session_state.selected_conv}.json")
+            export_formats = {"JSON": "json", "NDJSON": "ndjson", "Markdown": "md", "Text": "txt"}
+            export_format = export_formats[st.selectbox("Export format", list(export_formats),
+                                                        label_visibility="collapsed")]
         with export_col2:
             if st.button("Export Chat"):
-                content = manager.export_conversation(st.session_state.selected_conv, "txt")
-                if content:
-                    st.download_button("Download Chat", content, f"{st.session_state.selected_conv}.txt")
+                # Written to exports/ a message at a time; images go into a folder next to it
+                export_path = manager.export_conversation(st.session_state.selected_conv, export_format)
+                if export_path:
+                    with open(export_path, 'rb') as f:
+                        st.download_button(f"Download {export_path.suffix[1:].upper()}", f, export_path.name,
+                                           mime=manager.exporter.FORMATS[export_format])
+                    st.caption(f"Saved to {export_path}")
         with export_col3:
             if st.button("Export Code"):
-                code_msgs = manager.extract_code_messages(st.session_state.selected_conv)
-                if code_msgs:
-                    options = [f"Message {i}: {msg['content'][:50]}..." for i, msg in code_msgs]
-                    selected = st.multiselect("Select code to export:", options)
-                    if selected and st.button("Export Selected"):
-                        indices = [code_msgs[i][0] for i in range(len(code_msgs)) if options[i] in selected]
-                        exported = manager.export_selected_code(st.session_state.selected_conv, indices)
-                        st.success(f"Exported {len(exported)} code snippets")
+                st.session_state.show_code_export = not st.session_state.get('show_code_export', False)
         with export_col4:
             if st.button("Export Images"):
                 conversation = manager.get_conversation(st.session_state.selected_conv)
-                image_messages = [msg for msg in conversation['messages'] if msg.get('image_data')]
+                image_messages = [msg for msg in conversation['messages']
+                                  if msg.get('image_ref') or msg.get('image_data')]
                 if image_messages:
                     for i, msg in enumerate(image_messages):
                         filename = f"image_{i}.png"
-                        if msg.get('image_data'):
+                        image_bytes = manager.get_image_bytes(msg)
+                        if image_bytes:
                             st.download_button(
                                 f"Download {filename}",
-                                base64.b64decode(msg['image_data']),
+                                image_bytes,
                                 filename,
                                 mime="image/png",
                                 key=f"download_img_{i}"
                             )
 
+        if st.session_state.get('show_code_export'):
+            # Code blocks come from the index built as messages were written
+            code_blocks = manager.list_code_blocks(st.session_state.selected_conv)
+            if not code_blocks:
+                st.info("No code blocks in this conversation.")
+            else:
+                options = {}
+                for code_block in code_blocks:
+                    first_line = code_block['code'].strip().split("\n")[0][:50]
+                    label = (f"Message {code_block['idx'] + 1}, block {code_block['block'] + 1} "
+                             f"({code_block['language'] or 'text'}): {first_line}")
+                    options[label] = (code_block['idx'], code_block['block'])
+                selected = st.multiselect("Select code to export:", list(options))
+                col1, col2 = st.columns([1, 1])
+                with col1:
+                    as_zip = st.checkbox("As one zip archive")
+                with col2:
+                    export_selected = st.button("Export Selected", disabled=not selected)
+                if export_selected:
+                    exported = manager.export_code_blocks(st.session_state.selected_conv,
+                                                          [options[label] for label in selected], as_zip)
+                    if as_zip:
+                        with open(exported[0], 'rb') as f:
+                            st.download_button("Download zip", f, exported[0].name, mime="application/zip")
+                    else:
+                        st.success(f"Exported {len(exported)} code snippets")
+
         if uploaded_files and submit_button:
             try:
                 stored_files = handle_multiple_files(uploaded_files, manager)
                 if st.session_state.selected_conv:
+                    # Text files are analyzed concurrently; the upload messages and log entries
+                    # are written together once every analysis is back
+                    analyses = {}
+                    text_count = sum(1 for file in stored_files if file['type'] == 'text')
+                    if text_count:
+                        progress = st.progress(0.0, text=f"Analyzing {text_count} files...")
+                        # Fraction finished per file; large files advance chunk by chunk
+                        file_progress = {}
+                        for i, done, total, record in manager.analyze_files(stored_files):
+                            file_progress[i] = done / total
+                            if record is None:
+                                status = f"Analyzing {stored_files[i]['name']} (section {done}/{total})"
+                            else:
+                                analyses[i] = record
+                                status = f"Analyzed {stored_files[i]['name']} ({len(analyses)}/{text_count} files)"
+                            progress.progress(sum(file_progress.values()) / text_count, text=status)
+                        progress.empty()
+
                     analysis_results = []
-                    for file in stored_files:
+                    for i, file in enumerate(stored_files):
                         if file['type'] == 'image':
                             analysis = f"Image file uploaded: {file['name']} (Format: {file['format']})"
-                            analysis_results.append({
-                                'name': file['name'],
-                                'language': 'image',
-                                'analysis': analysis
-                            })
                         else:
-                            analysis = manager.analyze_code(file['content'], file['language'])
-                            analysis_results.append({
-                                'name': file['name'],
-                                'language': file['language'],
-                                'analysis': analysis
-                            })
-
-                        metadata_message = f"File uploaded: {file['name']} ({file['type']})"
-                        manager.add_message(st.session_state.selected_conv, metadata_message, "user")
+                            analysis = analyses[i]['analysis']
+                        analysis_results.append({
+                            'name': file['name'],
+                            'language': file['language'],
+                            'analysis': analysis
+                        })
 
-                        if file['type'] == 'text':
-                            manager.log_file_analysis(file['name'], file['language'], analysis)
+                    manager.record_file_uploads(st.session_state.selected_conv, stored_files, analyses)
 
                     st.session_state.analysis_results = analysis_results
+                    # Counted per file from this upload's own records: a file is a hit when
+                    # its whole analysis came from the cache
+                    hits = sum(1 for record in analyses.values() if record.get('cached'))
+                    st.session_state.analysis_cache_stats = {'hits': hits, 'misses': len(analyses) - hits}
                     st.success("Files successfully uploaded.")
 
                     for file in stored_files:
                         if file['type'] == 'image':
-                            st.image(base64.b64decode(file['content']),
-                                     caption=file['name'],
-                                     use_container_width=True)
+                            st.image(manager.thumbnails.get(file['image_ref']['hash']), caption=file['name'])
 
             except Exception as e:
                 st.error(f"Error: {e}")
 
         if st.session_state.analysis_results:
             with st.expander("View Analysis Results"):
+                cache_stats = st.session_state.get('analysis_cache_stats')
+                if cache_stats:
+                    st.caption(f"Analysis cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
                 for result in st.session_state.analysis_results:
                     st.markdown(f"**Analysis for {result['name']} ({result['language']}):**\n{result['analysis']}")
 
-        # Token counting
+        # Token totals come precomputed from the conversation summary
         total_tokens = claude_tokens = gpt_tokens = dalle_tokens = gemini_tokens = input_tokens = 0
-
-        # Display messages and count tokens
-        for msg in conversation['messages']:
+        if summary:
+            service_tokens = summary['token_rollups']['by_service']
+            claude_tokens = service_tokens.get('claude', 0)
+            gpt_tokens = service_tokens.get('chatgpt', 0)
+            dalle_tokens = service_tokens.get('dalle', 0)
+            gemini_tokens = service_tokens.get('gemini', 0)
+            input_tokens = summary['token_rollups']['by_sender'].get('user', 0)
+            total_tokens = summary['total_tokens']
+
+        # Display the most recent messages
+        messages, window_start = manager.get_recent_messages(st.session_state.selected_conv,
+                                                             st.session_state.message_window)
+        if window_start > 0:
+            if st.button(f"⬆ Load earlier messages ({window_start} more)"):
+                st.session_state.message_window += MESSAGE_WINDOW
+                st.rerun()
+        for offset, msg in enumerate(messages, window_start):
             with st.chat_message(msg['sender']):
-                if msg.get('image_data'):
-                    st.image(base64.b64decode(msg['image_data']), use_container_width=True)
+                thumbnail = manager.get_thumbnail(msg)
+                if thumbnail:
+                    # The full image is read only while "Full size" is switched on
+                    st.image(thumbnail)
+                    if st.toggle("Full size", key=f"full_image_{st.session_state.selected_conv}_{offset}"):
+                        image_path = manager.get_image_path(msg)
+                        image_bytes = manager.get_image_bytes(msg)
+                        st.image(str(image_path) if image_path else image_bytes, use_container_width=True)
+                        mime = msg.get('image_ref', {}).get('mime', "image/png")
+                        st.download_button("Download image", image_bytes, f"image_{offset}.{mime.split('/')[-1]}",
+                                           mime=mime, key=f"download_full_image_{offset}")
                 st.write(msg['content'])
 
                 tokens = msg.get('tokens', 0)
-                total_tokens += tokens
-
-                # Count tokens based on message type
-                if msg['sender'] == 'user':
-                    input_tokens += tokens
-
-                # Count AI service tokens
-                if msg.get('ai_service') == 'claude':
-                    claude_tokens += tokens
-                elif msg.get('ai_service') == 'chatgpt':
-                    gpt_tokens += tokens
-                elif msg.get('ai_service') == 'dalle':
-                    dalle_tokens += tokens
-                elif msg.get('ai_service') == 'gemini':
-                    gemini_tokens += tokens
-
-                st.caption(f"Model: {msg.get('model', 'user')} | Tokens: {tokens}")
+                caption = f"Model: {msg.get('model', 'user')} | Tokens: {tokens}"
+                if msg.get('tokens_in') is not None:
+                    caption += f" | Input: {msg['tokens_in']}"
+                if msg.get('duration_ms') is not None:
+                    caption += f" | First token: {msg['ttft_ms'] / 1000:.2f}s | Total: {msg['duration_ms'] / 1000:.2f}s"
+                    if msg.get('partial'):
+                        caption += " | Stopped early"
+                if msg.get('latency_ms') is not None:
+                    caption += f" | Generated: {msg['generation_ms'] / 1000:.2f}s | Total: {msg['latency_ms'] / 1000:.2f}s"
+                st.caption(caption)
 
         # Token display in sidebar
         with st.sidebar:
@@ -595,10 +738,43 @@ def main():
                     st.session_state.selected_conv,
                     prompt,
                     model=model_key,
-                    size=size
+                    size=size,
+                    n=image_count
                 )
                 if image_data:
                     st.rerun()
+            elif st.session_state.ai_service == "All selected models":
+                response = None
+                if not board_targets:
+                    st.warning("Select at least one model for the board room.")
+                else:
+                    with st.chat_message("user"):
+                        st.write(prompt)
+                    # Replies are shown as each model finishes
+                    for ai_service, reply_model, reply in manager.send_to_models(
+                            st.session_state.selected_conv, prompt, board_targets):
+                        with st.chat_message("assistant"):
+                            st.write(reply)
+                            st.caption(f"Model: {reply_model}")
+                    response = True
+            elif stream_replies:
+                stream_methods = {
+                    "Claude": manager.stream_to_claude,
+                    "ChatGPT": manager.stream_to_chatgpt,
+                    "Gemini": manager.stream_to_gemini
+                }
+                with st.chat_message("user"):
+                    st.write(prompt)
+                stream = stream_methods[st.session_state.ai_service](st.session_state.selected_conv, prompt, model_key)
+                try:
+                    with st.chat_message("assistant"):
+                        response = st.write_stream(stream)
+                except Exception as e:
+                    response = None
+                    st.error(f"Error: {e}")
+                finally:
+                    # Closing the stream saves whatever arrived, even if the run was stopped partway
+                    stream.close()
             elif st.session_state.ai_service == "Claude":
                 response = manager.send_to_claude(st.session_state.selected_conv, prompt, model_key)
             elif st.session_state.ai_service == "ChatGPT":
@@ -608,6 +784,12 @@ def main():
             if response:
                 st.rerun()
 
+    with st.sidebar:
+        with st.expander("Startup timings"):
+            st.code(format_startup_report())
+        with st.expander("Provider gateway"):
+            st.code(manager.gateway.format_stats())
+
     if st.session_state.show_code_popup:
         with st.expander("Code Viewer"):
             code_content = open(__file__, 'r').read()
@@ -0,0 +1,135 @@
+import asyncio
+import os
+
+from chat_manager import get_manager
+from startup_timing import timed
+
+
+class AsyncChatHistoryManager:
+    # asyncio counterpart of the ChatHistoryManager provider calls, for headless batch jobs
+    # and server front ends. Requests go through the SDKs' async clients, so many
+    # conversations can be in flight from one event loop without a thread per request.
+    # Storage reads and writes run in worker threads so they never block the loop, and each
+    # provider has its own concurrency limit. Calls share the manager's provider gateway, so
+    # rate limits and circuit breakers apply across sync and async callers alike.
+
+    CONCURRENCY_LIMITS = {
+        "claude": 8,
+        "chatgpt": 8,
+        "gemini": 4
+    }
+
+    def __init__(self, manager=None, limits=None):
+        self.manager = manager or get_manager()
+        self.limits = {**self.CONCURRENCY_LIMITS, **(limits or {})}
+        self._semaphores = {}
+        self._openai = None
+        self._anthropic = None
+        self._gemini = None
+
+    @property
+    def openai(self):
+        if self._openai is None:
+            with timed("import openai"):
+                import openai
+            with timed("init AsyncOpenAI client"):
+                self._openai = openai.AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0)
+        return self._openai
+
+    @property
+    def anthropic(self):
+        if self._anthropic is None:
+            with timed("import anthropic"):
+                from anthropic import AsyncAnthropic
+            with timed("init AsyncAnthropic client"):
+                self._anthropic = AsyncAnthropic(api_key=os.getenv('ANTHROPIC_API_KEY'), max_retries=0)
+        return self._anthropic
+
+    @property
+    def gemini(self):
+        # The Gemini SDK exposes async generation on the same model object
+        if self._gemini is None:
+            self._gemini = self.manager.gemini
+        return self._gemini
+
+    def _limit(self, ai_service):
+        if ai_service not in self._semaphores:
+            self._semaphores[ai_service] = asyncio.Semaphore(self.limits[ai_service])
+        return self._semaphores[ai_service]
+
+    async def get_conversation(self, conv_id):
+        return await asyncio.to_thread(self.manager.get_conversation, conv_id)
+
+    async def send_to_claude(self, conv_id, prompt, model="claude-3-sonnet-20240229"):
+        return await self._send("claude", conv_id, prompt, model)
+
+    async def send_to_chatgpt(self, conv_id, prompt, model="gpt-3.5-turbo"):
+        return await self._send("chatgpt", conv_id, prompt, model)
+
+    async def send_to_gemini(self, conv_id, prompt, model="gemini-pro"):
+        return await self._send("gemini", conv_id, prompt, model)
+
+    async def send_to_models(self, conv_id, prompt, targets):
+        # Async board-room fan-out: returns {(ai_service, model): reply}, saving each reply as
+        # it finishes
+        conversation = await self.get_conversation(conv_id)
+        budget = min(self.manager.CONTEXT_TOKEN_BUDGETS.get(model, self.manager.DEFAULT_CONTEXT_BUDGET)
+                     for _, model in targets)
+        context, context_tokens = self.manager._get_conversation_context(conv_id, conversation, budget=budget)
+        await asyncio.to_thread(self.manager.add_message, conv_id, prompt, "user", "board",
+                                ", ".join(model for _, model in targets))
+
+        async def ask(ai_service, model):
+            try:
+                async with self._limit(ai_service):
+                    response_content, _, tokens_out = await self._complete(ai_service, context, context_tokens,
+                                                                           prompt, model)
+            except Exception as e:
+                print(f"{ai_service} Error: {str(e)}")
+                return f"Error: {str(e)}"
+            await asyncio.to_thread(self.manager.add_message, conv_id, response_content, "assistant",
+                                    ai_service, model, tokens_out)
+            return response_content
+
+        replies = await asyncio.gather(*(ask(ai_service, model) for ai_service, model in targets))
+        return dict(zip(targets, replies))
+
+    async def _send(self, ai_service, conv_id, prompt, model):
+        try:
+            conversation = await self.get_conversation(conv_id)
+            context, context_tokens = self.manager._get_conversation_context(conv_id, conversation, model)
+
+            async with self._limit(ai_service):
+                response_content, tokens_in, tokens_out = await self._complete(ai_service, context, context_tokens,
+                                                                               prompt, model)
+
+            await asyncio.to_thread(self._save_exchange, conv_id, prompt, response_content, ai_service, model,
+                                    tokens_in, tokens_out)
+            return response_content
+
+        except Exception as e:
+            print(f"{ai_service} Error: {str(e)}")
+            return f"Error: {str(e)}"
+
+    def _save_exchange(self, conv_id, prompt, response_content, ai_service, model, tokens_in, tokens_out):
+        self.manager._append_messages(conv_id, [
+            self.manager._new_message(prompt, "user", ai_service, model, tokens_in),
+            self.manager._new_message(response_content, "assistant", ai_service, model, tokens_out)
+        ])
+
+    async def _complete(self, ai_service, context, context_tokens, prompt, model):
+        # Same contract as ChatHistoryManager._complete, sharing its request building and
+        # usage handling; only the call itself goes through the async clients
+        manager = self.manager
+        request, prompt_tokens = manager._provider_request(ai_service, context, context_tokens, prompt, model)
+        response = await manager.gateway.call_async(ai_service, lambda: self._provider_call(ai_service, request),
+                                                    manager._reserved_tokens(request, prompt_tokens))
+        reply, usage = manager._provider_reply(ai_service, response)
+        return manager._settle_reply(ai_service, model, reply, usage, request, prompt_tokens)
+
+    def _provider_call(self, ai_service, request):
+        if ai_service == "claude":
+            return self.anthropic.messages.create(**request)
+        if ai_service == "chatgpt":
+            return self.openai.chat.completions.create(**request)
+        return self.gemini.generate_content_async(**request)
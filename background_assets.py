@@ -0,0 +1,81 @@
+import base64
+import hashlib
+import io
+import os
+import threading
+from pathlib import Path
+
+from startup_timing import timed
+
+# Background images are served as resized, recompressed variants rather than the originals.
+# Each variant is built once and stored under backgrounds/.variants, named after the source
+# file's content hash, so it is reused across reruns and restarts and rebuilt only when the
+# file itself changes. app.py caches the listing and the finished CSS per rerun.
+
+BACKGROUND_DIR = Path("backgrounds")
+VARIANT_DIR = BACKGROUND_DIR / ".variants"
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+MAX_WIDTH = 1920
+JPEG_QUALITY = 80
+
+_lock = threading.Lock()
+
+
+def list_backgrounds(directory=BACKGROUND_DIR):
+    directory.mkdir(exist_ok=True)
+    return sorted(entry.name for entry in os.scandir(directory)
+                  if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def source_key(name, directory=BACKGROUND_DIR):
+    # (name, size, mtime_ns): changes whenever the file is replaced or edited, so callers can
+    # use it as a cache key without reading the file
+    stat = (directory / name).stat()
+    return name, stat.st_size, stat.st_mtime_ns
+
+
+def variant_path(name, directory=BACKGROUND_DIR):
+    source = directory / name
+    with open(source, 'rb') as f:
+        content_hash = hashlib.sha256(f.read()).hexdigest()
+    path = VARIANT_DIR / f"{content_hash[:32]}_{MAX_WIDTH}.jpg"
+    if not path.exists():
+        with _lock:
+            if not path.exists():
+                _build_variant(source, path)
+    return path
+
+
+def _build_variant(source, path):
+    with timed("import PIL"):
+        from PIL import Image
+
+    with Image.open(source) as image:
+        if image.width > MAX_WIDTH:
+            image = image.resize((MAX_WIDTH, round(image.height * MAX_WIDTH / image.width)), Image.LANCZOS)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=JPEG_QUALITY, optimize=True, progressive=True)
+
+    path.parent.mkdir(exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(buffer.getvalue())
+    os.replace(tmp_path, path)
+
+
+def background_css(name, directory=BACKGROUND_DIR):
+    # A style block that puts the background's variant behind the app as a data URI
+    with open(variant_path(name, directory), 'rb') as f:
+        encoded = base64.b64encode(f.read()).decode()
+    return f"""
+        <style>
+        .stApp {{
+            background-image: url("data:image/jpeg;base64,{encoded}") !important;
+            background-size: cover !important;
+            background-position: center !important;
+            background-attachment: fixed !important;
+        }}
+        </style>
+    """
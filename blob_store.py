@@ -0,0 +1,57 @@
+import hashlib
+import os
+import threading
+from pathlib import Path
+
+
+class BlobStore:
+    # Content-addressed storage for image bytes. Each blob is written once under its SHA-256
+    # (blobs/ab/abcdef...), so identical images are stored a single time and messages only
+    # carry a small reference: {"hash": ..., "mime": ..., "size": ...}.
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(exist_ok=True)
+
+    def put(self, data, mime="image/png"):
+        blob_hash = hashlib.sha256(data).hexdigest()
+        path = self.path(blob_hash)
+        if not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return {"hash": blob_hash, "mime": mime, "size": len(data)}
+
+    def put_stream(self, chunks, mime="image/png"):
+        # Like put, for data arriving in pieces (an HTTP download): each chunk is hashed and
+        # written to a temporary file as it comes, so the whole blob is never held in memory
+        digest = hashlib.sha256()
+        size = 0
+        tmp_path = self.root / f".incoming.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in chunks:
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            blob_hash = digest.hexdigest()
+            path = self.path(blob_hash)
+            if not path.exists():
+                path.parent.mkdir(exist_ok=True)
+                os.replace(tmp_path, path)
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+        return {"hash": blob_hash, "mime": mime, "size": size}
+
+    def get(self, blob_hash):
+        with open(self.path(blob_hash), 'rb') as f:
+            return f.read()
+
+    def path(self, blob_hash):
+        return self.root / blob_hash[:2] / blob_hash
+
+    def exists(self, blob_hash):
+        return self.path(blob_hash).exists()
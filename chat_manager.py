@@ -1,15 +1,30 @@
 import base64
-import json
+import hashlib
 import os
-import tiktoken
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
 
-import google.generativeai as genai
-import openai
-from anthropic import Anthropic
 from dotenv import load_dotenv
-from google.generativeai import GenerativeModel
+
+from analysis_cache import AnalysisCache
+from analysis_log import AnalysisLog
+from blob_store import BlobStore
+from code_chunks import find_code_blocks, split_code
+from exporter import ConversationExporter
+from provider_gateway import ProviderGateway
+from search_index import SearchIndex
+from thumbnails import ThumbnailCache
+from startup_timing import timed
+from storage import create_storage
+from token_counter import TokenizerRegistry
+
+# The provider SDKs and tiktoken are imported inside the client properties below, so each one
+# is only loaded once its service is first used
 
 
 class ChatHistoryManager:
@@ -33,117 +48,409 @@ class ChatHistoryManager:
         "dall-e-2": "DALL-E 2"
     }
 
-    def __init__(self):
-        load_dotenv()
+    # Parsed conversations kept in memory, validated against the storage version on every read
+    CONVERSATION_CACHE_SIZE = 32
+
+    # Token budget for the conversation history sent along with each prompt
+    CONTEXT_TOKEN_BUDGETS = {
+        "claude-3-sonnet-20240229": 16000,
+        "claude-3-opus-20240229": 16000,
+        "claude-3-haiku-20240307": 16000,
+        "gpt-4": 4000,
+        "gpt-3.5-turbo": 8000,
+        "gemini-pro": 16000
+    }
+    DEFAULT_CONTEXT_BUDGET = 4000
+
+    # Claude calls in flight at once when several uploaded files are analyzed
+    ANALYSIS_CONCURRENCY = 4
+    ANALYSIS_MODEL = "claude-3-sonnet-20240229"
+    ANALYSIS_PROMPT = """Analyze this {language} code:
+```{language}
+{content}
+```
+Provide a concise analysis covering:
+1. Main functionality
+2. Key components
+3. Potential improvements or issues
+4. Suggestions for enhancement"""
+    # Files longer than max_length are analyzed in chunks of about this many tokens, cut on
+    # function and class boundaries, and the chunk analyses are merged by a final call
+    ANALYSIS_CHUNK_TOKENS = 3000
+    ANALYSIS_CHUNK_PROMPT = """This is one section of a larger {language} file:
+```{language}
+{content}
+```
+Briefly describe what this section does and note any issues or improvements."""
+    ANALYSIS_REDUCE_PROMPT = """Below are analyses of consecutive sections of one {language} file.
+Combine them into a single concise analysis of the whole file covering:
+1. Main functionality
+2. Key components
+3. Potential improvements or issues
+4. Suggestions for enhancement
+
+{content}"""
+
+    # Hosts the download session keeps a connection pool for
+    DOWNLOAD_HOST_POOLS = 4
+    # Connections kept per host by the download session, and bytes read per download step
+    DOWNLOAD_POOL_SIZE = 10
+    DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+    # Longest Claude reply asked for, and reserved against the token limit up front
+    CLAUDE_MAX_TOKENS = 1024
+
+    SYSTEM_PROMPT = "You're participating in a group chat. Previous messages are provided for context. Respond naturally."
 
     def __init__(self):
         load_dotenv()
-        if os.getenv('OPENAI_API_KEY'):
-            self.openai = openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-            self.dalle_enabled = True
-        else:
-            self.dalle_enabled = False
-
-        if os.getenv('ANTHROPIC_API_KEY'):
-            self.anthropic = Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY'))
-
-        if os.getenv('GOOGLE_API_KEY'):
-            genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
-            self.gemini = GenerativeModel('gemini-pro')
+        self.dalle_enabled = bool(os.getenv('OPENAI_API_KEY'))
+
+        # Provider clients are built the first time they are used and then reused, so each
+        # client's HTTP connection pool stays warm between messages
+        self._client_lock = threading.Lock()
+        self._openai = None
+        self._anthropic = None
+        self._gemini = None
+        self._http = None
+        # Rate limits, retries and circuit breaking for every provider call; the SDK clients'
+        # own retries are turned off so a failing request is not retried at two levels
+        self.gateway = ProviderGateway()
+        # Encoders are loaded on first use and token counts are memoized
+        self.tokenizers = TokenizerRegistry()
+
         self.history_dir = Path("chat_histories")
         self.exports_dir = Path("exports")
         self.history_dir.mkdir(exist_ok=True)
         self.exports_dir.mkdir(exist_ok=True)
-        self.gpt_encoder = tiktoken.encoding_for_model("gpt-4")
+        # CHAT_STORAGE selects the backend: "file" (one message log per conversation) or "sqlite"
+        self.storage = create_storage(os.getenv('CHAT_STORAGE', 'file'), self.history_dir)
+        # Image bytes live in a content-addressed blob store; messages only hold a reference
+        self.blob_store = BlobStore(Path("blobs"))
+        # The chat stream shows size-bounded thumbnails; full images load only when opened
+        self.thumbnails = ThumbnailCache(self.blob_store)
+        self.exporter = ConversationExporter(self.blob_store)
+        # Blob hashes of inline base64 images from unmigrated histories, keyed by a digest of the text
+        self._inline_image_hashes = {}
+        # Analyses of unchanged files are answered from disk instead of a new Claude call
+        self.analysis_cache = AnalysisCache(Path("analysis_cache"))
+        self._analysis_slots = threading.BoundedSemaphore(self.ANALYSIS_CONCURRENCY)
+        # Every analysis is recorded here; file_analysis_log.txt is only read by the importer
+        self.analysis_log = AnalysisLog(self.history_dir / "analyses.db")
+        # Full-text index over message content, updated as messages are appended
+        self.search_index = SearchIndex(self.history_dir / "search.db")
+
+        # Treat conversations returned by get_conversation as read-only; they are shared with the cache
+        self._conversation_cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        # Formatted context lines and their token counts per conversation, extended as messages arrive
+        self._context_cache = OrderedDict()
+        self._context_lock = threading.Lock()
+
+    @property
+    def openai(self):
+        if self._openai is None:
+            with self._client_lock:
+                if self._openai is None:
+                    with timed("import openai"):
+                        import openai
+                    with timed("init OpenAI client"):
+                        self._openai = openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0)
+        return self._openai
+
+    @property
+    def anthropic(self):
+        if self._anthropic is None:
+            with self._client_lock:
+                if self._anthropic is None:
+                    with timed("import anthropic"):
+                        from anthropic import Anthropic
+                    with timed("init Anthropic client"):
+                        self._anthropic = Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY'), max_retries=0)
+        return self._anthropic
+
+    @property
+    def gemini(self):
+        if self._gemini is None:
+            with self._client_lock:
+                if self._gemini is None:
+                    with timed("import google.generativeai"):
+                        import google.generativeai as genai
+                    with timed("init Gemini model"):
+                        genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
+                        self._gemini = genai.GenerativeModel('gemini-pro')
+        return self._gemini
+
+    @property
+    def http(self):
+        # Pooled HTTP session for downloads such as DALL-E image URLs, so repeated downloads
+        # reuse connections instead of opening a new one each time
+        if self._http is None:
+            with self._client_lock:
+                if self._http is None:
+                    with timed("import requests"):
+                        import requests
+                        from requests.adapters import HTTPAdapter
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=self.DOWNLOAD_HOST_POOLS, pool_maxsize=self.DOWNLOAD_POOL_SIZE)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._http = session
+        return self._http
 
     def create_conversation(self, title):
         conv_id = f"{title}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        conv_path = self.history_dir / f"{conv_id}.json"
-        conversation = {
+        header = {
             "title": title,
-            "created_at": datetime.now().isoformat(),
-            "messages": []
+            "created_at": datetime.now().isoformat()
         }
-        self._save_conversation(conv_path, conversation)
+        self.storage.create_conversation(conv_id, header)
         return conv_id
 
-    def generate_image_dalle(self, conv_id, prompt, model="dall-e-3", size="1024x1024"):
+    def generate_image_dalle(self, conv_id, prompt, model="dall-e-3", size="1024x1024", n=1,
+                             response_format="b64_json"):
+        # Generates n images (DALL-E 3 only makes one per request) and stores them as blobs.
+        # With b64_json the image bytes come back in the API response itself; with url each
+        # image is streamed to disk over the pooled HTTP session. Several images are stored
+        # concurrently. Returns the image_refs, or None on failure.
         try:
+            start = time.perf_counter()
             # Calculate DALL-E token equivalents
             dalle_prompt_tokens = self.estimate_tokens(prompt)  # Count actual prompt tokens
             dalle_image_tokens = 4000 if model == "dall-e-3" else 2000  # Base image generation tokens
 
-            response = self.openai.images.generate(
+            response = self.gateway.call("dalle", lambda: self.openai.images.generate(
                 model=model,
                 prompt=prompt,
                 size=size,
                 quality="standard",
-                n=1
-            )
-
-            image_url = response.data[0].url
+                n=n,
+                response_format=response_format
+            ))
+            generation_ms = round((time.perf_counter() - start) * 1000)
 
-            # Download the image and convert to base64
-            import requests
-            image_data = requests.get(image_url).content
-            image_b64 = base64.b64encode(image_data).decode('utf-8')
+            with ThreadPoolExecutor(max_workers=max(len(response.data), 1)) as executor:
+                image_refs = list(executor.map(self._store_generated_image, response.data))
+            latency_ms = round((time.perf_counter() - start) * 1000)
 
             # Save the prompt message with actual token count
-            self.add_message(conv_id, prompt, "user", "dalle", model, dalle_prompt_tokens)
-
-            # Save the image message with generation token count
-            image_message = {
-                "content": f"Generated image for prompt: {prompt}",
-                "image_data": image_b64,
-                "sender": "assistant",
-                "timestamp": datetime.now().isoformat(),
-                "ai_service": "dalle",
-                "model": model,
-                "tokens": dalle_image_tokens
-            }
+            prompt_message = self._new_message(prompt, "user", "dalle", model, dalle_prompt_tokens)
 
-            conversation = self.get_conversation(conv_id)
-            conversation["messages"].append(image_message)
-            self._save_conversation(self._get_conv_path(conv_id), conversation)
+            # Save one image message per image with generation token count and timings
+            image_messages = [
+                self._new_message(f"Generated image for prompt: {prompt}", "assistant", "dalle", model,
+                                  dalle_image_tokens, image_ref=image_ref, generation_ms=generation_ms,
+                                  latency_ms=latency_ms)
+                for image_ref in image_refs
+            ]
 
-            return image_b64
+            self._append_messages(conv_id, [prompt_message] + image_messages)
+
+            return image_refs
 
         except Exception as e:
             print(f"DALL-E Error: {str(e)}")
             return None
 
-    def analyze_code(self, content, language, max_length=8000):
-        truncated_content = content if len(content) <= max_length \
-            else content[:max_length] + "\n...\n[Content Truncated]"
-        analysis_prompt = f"""Analyze this {language} code:
-```{language}
-{truncated_content}
-```
-Provide a concise analysis covering:
-1. Main functionality
-2. Key components
-3. Potential improvements or issues
-4. Suggestions for enhancement"""
+    def _store_generated_image(self, image):
+        if image.b64_json:
+            return self.store_image(base64.b64decode(image.b64_json), "image/png")
+        with self.http.get(image.url, stream=True, timeout=60) as download:
+            download.raise_for_status()
+            image_ref = self.blob_store.put_stream(download.iter_content(self.DOWNLOAD_CHUNK_SIZE),
+                                                   download.headers.get('Content-Type', "image/png"))
+        self._pregenerate_thumbnail(image_ref)
+        return image_ref
+
+    def analyze_code(self, content, language, max_length=8000, progress=None):
+        return self.analyze_code_record(content, language, max_length, progress)["analysis"]
+
+    def analyze_code_record(self, content, language, max_length=8000, progress=None):
+        # Small files get one call. Larger ones are split into chunks that are analyzed
+        # concurrently and then merged; progress, if given, is called as progress(done, total)
+        # after each of those calls. Every call's result is cached by content hash.
+        # Returns an analysis log record without the file name; a failed analysis has an
+        # error field and its analysis is the error message.
+        start = time.perf_counter()
+        record = {
+            "created_at": datetime.now().isoformat(),
+            "language": language,
+            "content_hash": hashlib.sha256(content.encode('utf-8')).hexdigest(),
+            "model": self.ANALYSIS_MODEL,
+            "tokens_in": 0,
+            "tokens_out": 0,
+            "cached": False
+        }
         try:
-            response = self.anthropic.messages.create(
-                model="claude-3-sonnet-20240229",
-                max_tokens=1024,
-                messages=[{"role": "user", "content": analysis_prompt}]
-            )
-            return response.content[0].text
+            if len(content) <= max_length:
+                calls = [self._cached_analysis(self.ANALYSIS_PROMPT, content, language)]
+            else:
+                calls = self._chunked_analysis(content, language, progress)
+            record["analysis"] = calls[-1][0]
+            record["tokens_in"] = sum(tokens_in for _, tokens_in, _, _ in calls)
+            record["tokens_out"] = sum(tokens_out for _, _, tokens_out, _ in calls)
+            record["cached"] = all(cached for _, _, _, cached in calls)
         except Exception as e:
-            return f"Analysis error: {str(e)}"
+            record["error"] = str(e)
+            record["analysis"] = f"Analysis error: {str(e)}"
+        record["latency_ms"] = round((time.perf_counter() - start) * 1000)
+        return record
+
+    def _chunked_analysis(self, content, language, progress):
+        # Returns the calls made, each (analysis, tokens in, tokens out, cached); the merged
+        # analysis is the last one
+        cache_key = self.analysis_cache.key(content, language, self.ANALYSIS_MODEL, self.ANALYSIS_REDUCE_PROMPT)
+        cached = self.analysis_cache.get(cache_key)
+        if cached is not None:
+            return [(cached, 0, 0, True)]
+
+        chunks = split_code(content, self.ANALYSIS_CHUNK_TOKENS,
+                            lambda texts: self.estimate_tokens_batch(texts, self.ANALYSIS_MODEL))
+        if len(chunks) == 1:
+            # Over max_length characters but within one chunk's token budget: a single call
+            # answers it, with nothing to merge
+            return [self._cached_analysis(self.ANALYSIS_PROMPT, content, language)]
+        total = len(chunks) + 1
+        calls = [None] * len(chunks)
+        with ThreadPoolExecutor(max_workers=min(len(chunks), self.ANALYSIS_CONCURRENCY)) as executor:
+            futures = {executor.submit(self._cached_analysis, self.ANALYSIS_CHUNK_PROMPT, chunk, language): n
+                       for n, chunk in enumerate(chunks)}
+            for done, future in enumerate(as_completed(futures), 1):
+                calls[futures[future]] = future.result()
+                if progress:
+                    progress(done, total)
+
+        sections = "\n\n".join(f"Section {n} of {len(chunks)}:\n{call[0]}" for n, call in enumerate(calls, 1))
+        analysis, tokens_in, tokens_out = self._request_analysis(
+            self.ANALYSIS_REDUCE_PROMPT.format(language=language, content=sections))
+        if progress:
+            progress(total, total)
+        self._cache_analysis(cache_key, analysis)
+        return calls + [(analysis, tokens_in, tokens_out, False)]
+
+    def _cached_analysis(self, template, content, language):
+        cache_key = self.analysis_cache.key(content, language, self.ANALYSIS_MODEL, template)
+        cached = self.analysis_cache.get(cache_key)
+        if cached is not None:
+            return cached, 0, 0, True
+        analysis, tokens_in, tokens_out = self._request_analysis(template.format(language=language, content=content))
+        self._cache_analysis(cache_key, analysis)
+        return analysis, tokens_in, tokens_out, False
+
+    def _request_analysis(self, analysis_prompt):
+        # Every analysis call, whether for a whole file, a chunk or the merge, takes a slot,
+        # so nested fan-out never has more than ANALYSIS_CONCURRENCY requests in flight
+        request = {"model": self.ANALYSIS_MODEL, "max_tokens": self.CLAUDE_MAX_TOKENS,
+                   "messages": [{"role": "user", "content": analysis_prompt}]}
+        prompt_tokens = self.estimate_tokens(analysis_prompt, self.ANALYSIS_MODEL)
+        with self._analysis_slots:
+            response = self.gateway.call("claude", lambda: self._provider_call("claude", request),
+                                         self._reserved_tokens(request, prompt_tokens))
+        analysis, usage = self._provider_reply("claude", response)
+        return self._settle_reply("claude", self.ANALYSIS_MODEL, analysis, usage, request, prompt_tokens)
+
+    def _cache_analysis(self, cache_key, analysis):
+        try:
+            self.analysis_cache.put(cache_key, analysis)
+        except Exception as e:
+            print(f"Analysis cache error: {str(e)}")
+
+    def analyze_files(self, files):
+        # Analyzes the text files among files (dicts from the upload handler) concurrently.
+        # Yields (index, done, total, record) events: chunk progress for large files with
+        # record None, then a final event carrying the analysis record once the file is
+        # finished. Nothing is written here; see record_file_uploads.
+        text_files = [(i, file) for i, file in enumerate(files) if file['type'] == 'text']
+        # Worker threads report through a queue so events reach the caller's thread
+        events = queue.Queue()
+
+        def analyze(i, file):
+            try:
+                record = self.analyze_code_record(file['content'], file['language'],
+                                                  progress=lambda done, total: events.put((i, done, total, None)))
+            except Exception as e:
+                record = {"language": file['language'], "error": str(e), "analysis": f"Analysis error: {str(e)}"}
+            events.put((i, 1, 1, record))
+
+        with ThreadPoolExecutor(max_workers=max(min(len(text_files), self.ANALYSIS_CONCURRENCY), 1)) as executor:
+            for i, file in text_files:
+                executor.submit(analyze, i, file)
+            finished = 0
+            while finished < len(text_files):
+                event = events.get()
+                if event[3] is not None:
+                    finished += 1
+                yield event
+
+    def record_file_uploads(self, conv_id, files, records):
+        # One history write for every upload message and one log write for every analysis.
+        # records maps a file's index in files to its analysis record from analyze_files.
+        # Failed analyses are not logged, so they never show up as a file's previous analysis.
+        self._append_messages(conv_id, [
+            self._new_message(f"File uploaded: {file['name']} ({file['type']})", "user",
+                              **({"image_ref": file['image_ref']} if file.get('image_ref') else {}))
+            for file in files
+        ])
+        self.log_file_analyses([{**records[i], "file_name": files[i]['name']} for i in sorted(records)
+                                if not records[i].get("error")])
 
     def log_file_analysis(self, file_name, language, analysis_summary):
-        log_file = Path("file_analysis_log.txt")
-        with open(log_file, "a", encoding="utf-8") as f:
-            log_entry = f"[{datetime.now().isoformat()}] File: {file_name}, Language: {language}\nAnalysis:\n{analysis_summary}\n\n"
-            f.write(log_entry)
+        self.log_file_analyses([{"file_name": file_name, "language": language, "analysis": analysis_summary}])
 
-    def add_message(self, conv_id, content, sender, ai_service=None, model=None, tokens=None):
-        conv_path = self._get_conv_path(conv_id)
-        conversation = self._load_conversation(conv_path)
+    def log_file_analyses(self, records):
+        timestamp = datetime.now().isoformat()
+        try:
+            self.analysis_log.record([{"created_at": timestamp, **record} for record in records])
+        except Exception as e:
+            print(f"Analysis log error: {str(e)}")
+
+    def previous_analysis(self, file_name, content):
+        # The latest logged analysis of exactly this content, else the latest one for a file
+        # of the same name (which may have changed since). None if it was never analyzed.
+        record = self.analysis_log.latest_for_hash(hashlib.sha256(content.encode('utf-8')).hexdigest())
+        if record:
+            record["unchanged"] = True
+            return record
+        record = self.analysis_log.latest_for_file(file_name)
+        if record:
+            record["unchanged"] = False
+        return record
+
+    def add_message(self, conv_id, content, sender, ai_service=None, model=None, tokens=None, image_ref=None):
+        message = self._new_message(content, sender, ai_service, model, tokens)
+        if image_ref:
+            message["image_ref"] = image_ref
+        self._append_messages(conv_id, [message])
+
+    def _append_messages(self, conv_id, messages):
+        # All messages go to storage in one write, and a cached copy of the conversation is
+        # extended in place when nothing else has written to it since it was loaded
+        versions = self.storage.append_messages(conv_id, messages)
+        start = None
+        with self._cache_lock:
+            cached = self._conversation_cache.get(conv_id)
+            if cached is not None:
+                if versions is not None and cached[0] == versions[0]:
+                    start = len(cached[1]["messages"])
+                    cached[1]["messages"].extend(messages)
+                    self._conversation_cache[conv_id] = (versions[1], cached[1])
+                else:
+                    del self._conversation_cache[conv_id]
+        self._index_messages(conv_id, start, messages)
+
+    def _index_messages(self, conv_id, start, messages):
+        # Adds newly appended messages to the search index. start is their offset in the
+        # conversation when the cache knows it; otherwise it comes from the stored summary.
+        try:
+            if start is None:
+                start = self.storage.get_summary(conv_id)["message_count"] - len(messages)
+            if not self.search_index.add_messages(conv_id, start, messages):
+                # The index had fallen behind (or another writer got in between); catch up
+                self.search_index.index_conversation(conv_id, self.storage.load_conversation(conv_id)["messages"])
+        except Exception as e:
+            print(f"Search index error: {str(e)}")
 
+    def _new_message(self, content, sender, ai_service=None, model=None, tokens=None, **extra):
         # If tokens not provided, estimate them
         if tokens is None:
             tokens = self.estimate_tokens(content)
@@ -154,65 +461,125 @@ Provide a concise analysis covering:
             "timestamp": datetime.now().isoformat(),
             "ai_service": ai_service,
             "model": model,
-            "tokens": tokens
+            "tokens": tokens,
+            **extra
         }
-        conversation["messages"].append(message)
-        self._save_conversation(conv_path, conversation)
+        # Size of the message as a context line, counted once here so building context never re-tokenizes it
+        message["context_tokens"] = self.estimate_tokens(self._context_line(message))
+        # Fenced code blocks are located once, here, and indexed from these ranges
+        message["code_blocks"] = find_code_blocks(str(content))
+        return message
 
     def get_conversation(self, conv_id):
         try:
-            return self._load_conversation(self._get_conv_path(conv_id))
+            # The version is read before loading, so a write that lands in between only makes
+            # the cached copy look older than it is and it is reloaded next time
+            version = self.storage.conversation_version(conv_id)
+            with self._cache_lock:
+                cached = self._conversation_cache.get(conv_id)
+                if cached is not None and version is not None and cached[0] == version:
+                    self._conversation_cache.move_to_end(conv_id)
+                    return cached[1]
+
+            conversation = self.storage.load_conversation(conv_id)
+            with self._cache_lock:
+                self._conversation_cache[conv_id] = (version, conversation)
+                self._conversation_cache.move_to_end(conv_id)
+                while len(self._conversation_cache) > self.CONVERSATION_CACHE_SIZE:
+                    self._conversation_cache.popitem(last=False)
+            return conversation
         except Exception as e:
             print(f"Error getting conversation: {str(e)}")
             return None
 
+    def get_recent_messages(self, conv_id, count):
+        # (messages, start): the last count messages and the offset of the first one. Served
+        # from the cached conversation when it is current, otherwise read from the tail of
+        # storage without loading the whole history.
+        try:
+            version = self.storage.conversation_version(conv_id)
+            with self._cache_lock:
+                cached = self._conversation_cache.get(conv_id)
+                if cached is not None and version is not None and cached[0] == version:
+                    messages = cached[1]["messages"]
+                    start = max(len(messages) - count, 0)
+                    return messages[start:], start
+            return self.storage.load_tail(conv_id, count)
+        except Exception as e:
+            print(f"Error getting recent messages: {str(e)}")
+            return [], 0
+
     def list_conversations(self):
         try:
-            # Get all conversation files
-            conv_files = list(self.history_dir.glob("*.json"))
+            # Conversation IDs, newest first
+            return self.storage.list_conversations()
 
-            # Create a list of tuples (conv_id, creation_time)
-            conv_list = []
-            for file in conv_files:
-                try:
-                    with open(file, encoding='utf-8') as f:
-                        conv_data = json.load(f)
-                        created_at = datetime.fromisoformat(conv_data.get('created_at', '2000-01-01T00:00:00'))
-                        conv_list.append((file.stem, created_at))
-                except Exception as e:
-                    print(f"Error reading conversation {file}: {e}")
-                    continue
+        except Exception as e:
+            print(f"Error listing conversations: {str(e)}")
+            return []
 
-            # Sort by creation time in descending order (newest first)
-            conv_list.sort(key=lambda x: x[1], reverse=True)
+    def list_conversation_summaries(self):
+        # id, title, created_at, last_activity, message_count and total_tokens per conversation
+        try:
+            return self.storage.list_conversation_summaries()
+        except Exception as e:
+            print(f"Error listing conversations: {str(e)}")
+            return []
 
-            # Return just the conversation IDs in sorted order
-            return [conv[0] for conv in conv_list]
+    def get_conversation_summary(self, conv_id):
+        # The list_conversation_summaries entry plus token_rollups: token totals by_service,
+        # by_model and by_sender, kept up to date as messages are written
+        try:
+            return self.storage.get_summary(conv_id)
+        except Exception as e:
+            print(f"Error getting conversation summary: {str(e)}")
+            return None
 
+    def search_messages(self, query, ai_service=None, model=None, limit=50):
+        # Full-text search over every conversation; see SearchIndex.search for the result shape
+        try:
+            self._ensure_search_index()
+            return self.search_index.search(query, ai_service, model, limit)
         except Exception as e:
-            print(f"Error listing conversations: {str(e)}")
+            print(f"Search error: {str(e)}")
             return []
 
+    def _ensure_search_index(self):
+        # Builds the index from every conversation the first time it is needed. Appends index
+        # only their own conversation, so this goes by the recorded full build, not by
+        # whether the index holds anything yet.
+        if not self.search_index.is_built():
+            self.rebuild_search_index()
+
+    def _ensure_conversation_indexed(self, conv_id):
+        # Reindexes one conversation when the index does not hold exactly its stored messages,
+        # such as one saved before the index existed or before it tracked code blocks
+        if self.search_index.indexed_count(conv_id) != self.storage.get_summary(conv_id)["message_count"]:
+            self.search_index.index_conversation(conv_id, self.storage.load_conversation(conv_id)["messages"])
+
+    def rebuild_search_index(self):
+        # Reindexes every stored conversation; returns how many were indexed
+        conv_ids = self.storage.list_conversations()
+        for conv_id in conv_ids:
+            self.search_index.index_conversation(conv_id, self.storage.load_conversation(conv_id)["messages"])
+        self.search_index.mark_built()
+        return len(conv_ids)
+
+    def repair_token_rollups(self):
+        # Recomputes message counts and token rollups for every stored conversation
+        return self.storage.rebuild_summaries()
+
     def send_to_claude(self, conv_id, prompt, model="claude-3-sonnet-20240229"):
         try:
             conversation = self.get_conversation(conv_id)
-            context = self._get_conversation_context(conversation)
+            context, context_tokens = self._get_conversation_context(conv_id, conversation, model)
 
-            system_prompt = "You're participating in a group chat. Previous messages are provided for context. Respond naturally."
-            full_prompt = f"{system_prompt}\n\nContext:\n{context}\n\nUser: {prompt}"
+            response_content, tokens_in, tokens_out = self._complete("claude", context, context_tokens, prompt, model)
 
-            response = self.anthropic.messages.create(
-                model=model,
-                max_tokens=1024,
-                messages=[{"role": "user", "content": full_prompt}]
-            )
-
-            tokens_in = self.estimate_tokens(full_prompt)
-            response_content = response.content[0].text
-            tokens_out = self.estimate_tokens(response_content)
-
-            self.add_message(conv_id, prompt, "user", "claude", model, tokens_in)
-            self.add_message(conv_id, response_content, "assistant", "claude", model, tokens_out)
+            self._append_messages(conv_id, [
+                self._new_message(prompt, "user", "claude", model, tokens_in),
+                self._new_message(response_content, "assistant", "claude", model, tokens_out)
+            ])
             return response_content
 
         except Exception as e:
@@ -222,23 +589,14 @@ Provide a concise analysis covering:
     def send_to_chatgpt(self, conv_id, prompt, model="gpt-3.5-turbo"):
         try:
             conversation = self.get_conversation(conv_id)
-            context = self._get_conversation_context(conversation)
-
-            system_message = {"role": "system",
-                              "content": "You're participating in a group chat. Previous messages are provided for context. Respond naturally."}
-            user_message = {"role": "user", "content": f"Context:\n{context}\n\nUser: {prompt}"}
+            context, context_tokens = self._get_conversation_context(conv_id, conversation, model)
 
-            response = self.openai.chat.completions.create(
-                model=model,
-                messages=[system_message, user_message]
-            )
-
-            tokens_in = self.estimate_tokens(prompt)
-            response_content = response.choices[0].message.content
-            tokens_out = self.estimate_tokens(response_content)
+            response_content, tokens_in, tokens_out = self._complete("chatgpt", context, context_tokens, prompt, model)
 
-            self.add_message(conv_id, prompt, "user", "chatgpt", model, tokens_in)
-            self.add_message(conv_id, response_content, "assistant", "chatgpt", model, tokens_out)
+            self._append_messages(conv_id, [
+                self._new_message(prompt, "user", "chatgpt", model, tokens_in),
+                self._new_message(response_content, "assistant", "chatgpt", model, tokens_out)
+            ])
             return response_content
 
         except Exception as e:
@@ -248,90 +606,404 @@ Provide a concise analysis covering:
     def send_to_gemini(self, conv_id, prompt, model="gemini-pro"):
         try:
             conversation = self.get_conversation(conv_id)
-            context = self._get_conversation_context(conversation)
-            full_prompt = f"Context:\n{context}\n\nUser: {prompt}"
-
-            response = self.gemini.generate_content(full_prompt)
+            context, context_tokens = self._get_conversation_context(conv_id, conversation, model)
 
-            tokens_in = self.estimate_tokens(prompt)
-            tokens_out = self.estimate_tokens(response.text)
+            response_content, tokens_in, tokens_out = self._complete("gemini", context, context_tokens, prompt, model)
 
-            self.add_message(conv_id, prompt, "user", "gemini", model, tokens_in)
-            self.add_message(conv_id, response.text, "assistant", "gemini", model, tokens_out)
-            return response.text
+            self._append_messages(conv_id, [
+                self._new_message(prompt, "user", "gemini", model, tokens_in),
+                self._new_message(response_content, "assistant", "gemini", model, tokens_out)
+            ])
+            return response_content
 
         except Exception as e:
             print(f"Gemini Error: {str(e)}")
             return f"Error: {str(e)}"
 
+    def send_to_models(self, conv_id, prompt, targets):
+        # Board-room fan-out: asks every (ai_service, model) in targets the same question at
+        # once. The context is built once, the user message is saved once, and each reply is
+        # saved and yielded as (ai_service, model, reply) in the order the models finish, so
+        # the wall-clock time is roughly that of the slowest model.
+        conversation = self.get_conversation(conv_id)
+        budget = min(self.CONTEXT_TOKEN_BUDGETS.get(model, self.DEFAULT_CONTEXT_BUDGET) for _, model in targets)
+        context, context_tokens = self._get_conversation_context(conv_id, conversation, budget=budget)
+
+        # Each model's input is recorded on its reply (tokens_in) and counted there, so the
+        # shared prompt carries no tokens of its own. The models asked are kept in
+        # board_models rather than model, which holds a single model name everywhere else.
+        self._append_messages(conv_id, [self._new_message(prompt, "user", "board", tokens=0,
+                                                          board_models=[model for _, model in targets])])
+
+        with ThreadPoolExecutor(max_workers=max(len(targets), 1)) as executor:
+            futures = {
+                executor.submit(self._complete, ai_service, context, context_tokens, prompt, model): (ai_service, model)
+                for ai_service, model in targets
+            }
+            for future in as_completed(futures):
+                ai_service, model = futures[future]
+                try:
+                    response_content, tokens_in, tokens_out = future.result()
+                except Exception as e:
+                    print(f"{ai_service} Error: {str(e)}")
+                    yield ai_service, model, f"Error: {str(e)}"
+                    continue
+                self._append_messages(conv_id, [self._new_message(response_content, "assistant", ai_service, model,
+                                                                  tokens_out, tokens_in=tokens_in)])
+                yield ai_service, model, response_content
+
+    # Requests are built and replies read by the _provider_* helpers below, which the plain,
+    # streamed and async (async_chat_manager) calls all share. A reply comes back as (reply,
+    # tokens in, tokens out), with the counts taken from the usage the provider reports and
+    # estimated only when it reports none. Each call goes through the gateway, reserving the
+    # estimated prompt plus the longest allowed reply against the provider's token limit and
+    # settling the difference once the usage is known.
+
+    def _complete(self, ai_service, context, context_tokens, prompt, model):
+        request, prompt_tokens = self._provider_request(ai_service, context, context_tokens, prompt, model)
+        response = self.gateway.call(ai_service, lambda: self._provider_call(ai_service, request),
+                                     self._reserved_tokens(request, prompt_tokens))
+        reply, usage = self._provider_reply(ai_service, response)
+        return self._settle_reply(ai_service, model, reply, usage, request, prompt_tokens)
+
+    def _provider_request(self, ai_service, context, context_tokens, prompt, model):
+        # (keyword arguments for the SDK call, estimated prompt tokens)
+        if ai_service == "claude":
+            full_prompt = f"{self.SYSTEM_PROMPT}\n\nContext:\n{context}\n\nUser: {prompt}"
+            return ({"model": model, "max_tokens": self.CLAUDE_MAX_TOKENS,
+                     "messages": [{"role": "user", "content": full_prompt}]},
+                    self._claude_prompt_tokens(context_tokens, prompt))
+        if ai_service == "chatgpt":
+            return ({"model": model,
+                     "messages": [{"role": "system", "content": self.SYSTEM_PROMPT},
+                                  {"role": "user", "content": f"Context:\n{context}\n\nUser: {prompt}"}]},
+                    context_tokens + self.estimate_tokens(prompt, model))
+        if ai_service == "gemini":
+            return ({"contents": f"Context:\n{context}\n\nUser: {prompt}"},
+                    context_tokens + self.estimate_tokens(prompt, model))
+        raise ValueError(f"Unknown AI service: {ai_service}")
+
+    def _provider_call(self, ai_service, request):
+        if ai_service == "claude":
+            return self.anthropic.messages.create(**request)
+        if ai_service == "chatgpt":
+            return self.openai.chat.completions.create(**request)
+        return self.gemini.generate_content(**request)
+
+    def _provider_reply(self, ai_service, response):
+        # (reply text, reported (tokens in, tokens out) or None) from a complete response
+        if ai_service == "claude":
+            usage = response.usage
+            return response.content[0].text, usage and (usage.input_tokens, usage.output_tokens)
+        if ai_service == "chatgpt":
+            usage = response.usage
+            return response.choices[0].message.content, usage and (usage.prompt_tokens, usage.completion_tokens)
+        usage = getattr(response, 'usage_metadata', None)
+        return response.text, usage and (usage.prompt_token_count, usage.candidates_token_count)
+
+    def _reserved_tokens(self, request, prompt_tokens):
+        return prompt_tokens + request.get("max_tokens", 0)
+
+    def _settle_reply(self, ai_service, model, reply, usage, request, prompt_tokens):
+        tokens_in, tokens_out = usage or (prompt_tokens, self.estimate_tokens(reply, model))
+        self.gateway.adjust_tokens(ai_service, tokens_in + tokens_out - self._reserved_tokens(request, prompt_tokens))
+        return reply, tokens_in, tokens_out
+
+    def _claude_prompt_tokens(self, context_tokens, prompt):
+        # Size of the full Claude prompt from its parts; the context was already counted
+        template = f"{self.SYSTEM_PROMPT}\n\nContext:\n\n\nUser: "
+        return self.estimate_tokens(template, "claude") + context_tokens + self.estimate_tokens(prompt, "claude")
+
+    # Streams are rate limited and circuit broken but not retried: a retry after part of the
+    # reply has been shown would repeat it
+
+    def stream_to_claude(self, conv_id, prompt, model="claude-3-sonnet-20240229"):
+        conversation = self.get_conversation(conv_id)
+        context, context_tokens = self._get_conversation_context(conv_id, conversation, model)
+        request, prompt_tokens = self._provider_request("claude", context, context_tokens, prompt, model)
+
+        usage = {}
+
+        def chunks():
+            with self.gateway.guard("claude", self._reserved_tokens(request, prompt_tokens)), \
+                    self.anthropic.messages.stream(**request) as stream:
+                yield from stream.text_stream
+                final_message = stream.get_final_message()
+                usage.update(input=final_message.usage.input_tokens, output=final_message.usage.output_tokens)
+
+        yield from self._stream_reply(conv_id, prompt, "claude", model, request, prompt_tokens, chunks(), usage)
+
+    def stream_to_chatgpt(self, conv_id, prompt, model="gpt-3.5-turbo"):
+        conversation = self.get_conversation(conv_id)
+        context, context_tokens = self._get_conversation_context(conv_id, conversation, model)
+        request, prompt_tokens = self._provider_request("chatgpt", context, context_tokens, prompt, model)
+
+        usage = {}
+
+        def chunks():
+            with self.gateway.guard("chatgpt", self._reserved_tokens(request, prompt_tokens)), \
+                    self.openai.chat.completions.create(**request, stream=True,
+                                                        stream_options={"include_usage": True}) as stream:
+                for chunk in stream:
+                    if chunk.usage:
+                        usage.update(input=chunk.usage.prompt_tokens, output=chunk.usage.completion_tokens)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+
+        yield from self._stream_reply(conv_id, prompt, "chatgpt", model, request, prompt_tokens, chunks(), usage)
+
+    def stream_to_gemini(self, conv_id, prompt, model="gemini-pro"):
+        conversation = self.get_conversation(conv_id)
+        context, context_tokens = self._get_conversation_context(conv_id, conversation, model)
+        request, prompt_tokens = self._provider_request("gemini", context, context_tokens, prompt, model)
+
+        def chunks():
+            with self.gateway.guard("gemini", self._reserved_tokens(request, prompt_tokens)):
+                for chunk in self.gemini.generate_content(**request, stream=True):
+                    yield chunk.text
+
+        yield from self._stream_reply(conv_id, prompt, "gemini", model, request, prompt_tokens, chunks())
+
+    def _stream_reply(self, conv_id, prompt, ai_service, model, request, prompt_tokens, chunks, usage=None):
+        # Yields text chunks as they arrive and saves the exchange once the stream ends. The
+        # finally block also runs when the consumer stops early (the generator is closed),
+        # so a reply interrupted partway is still saved, marked as partial. usage is filled
+        # in by chunks with the provider-reported counts when the stream completes.
+        start = time.perf_counter()
+        first_token_at = None
+        parts = []
+        completed = False
+        try:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                parts.append(chunk)
+                yield chunk
+            completed = True
+        finally:
+            chunks.close()
+            if parts:
+                response_content = "".join(parts)
+                timing = {
+                    "ttft_ms": round((first_token_at - start) * 1000),
+                    "duration_ms": round((time.perf_counter() - start) * 1000)
+                }
+                if not completed:
+                    timing["partial"] = True
+                _, tokens_in, tokens_out = self._settle_reply(
+                    ai_service, model, response_content, usage and (usage["input"], usage["output"]),
+                    request, prompt_tokens)
+                self._append_messages(conv_id, [
+                    self._new_message(prompt, "user", ai_service, model, tokens_in),
+                    self._new_message(response_content, "assistant", ai_service, model, tokens_out, **timing)
+                ])
+
     def export_conversation(self, conv_id, format="json"):
-        conv = self.get_conversation(conv_id)
-        export_dir = Path("exports")
-        export_dir.mkdir(exist_ok=True)
+        # Streams the conversation from storage into exports/, images alongside it in their
+        # own folder, and returns the path of the export
+        try:
+            summary = self.storage.get_summary(conv_id)
+            export_dir = Path("exports")
+            export_dir.mkdir(exist_ok=True)
 
-        filename = f"{conv['title']}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        export_path = export_dir / f"{filename}.{format}"
+            filename = f"{summary['title']}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            return self.exporter.write(export_dir / f"{filename}.{format}", self._export_header(summary),
+                                       self.storage.iter_messages(conv_id), format)
+        except Exception as e:
+            print(f"Export error: {str(e)}")
+            return None
 
-        if format == "json":
-            content = json.dumps(conv, indent=2, ensure_ascii=False)
-        else:
-            content = ""
-            for msg in conv["messages"]:
-                ai_service = f"[{msg.get('ai_service', 'user')}]" if msg.get('ai_service') else ""
-                content += f"{msg['sender']} {ai_service}: {msg['content']}\n\n"
+    def _export_header(self, summary):
+        return {"title": summary["title"], "created_at": summary["created_at"]}
 
-        with open(export_path, 'w', encoding='utf-8') as f:
-            f.write(content)
-        return content
+    # File extensions for code block languages that are not already one
+    CODE_EXTENSIONS = {
+        "python": "py", "csharp": "cs", "c#": "cs", "javascript": "js", "typescript": "ts",
+        "bash": "sh", "shell": "sh", "markdown": "md", "yaml": "yml", "text": "txt", "": "txt"
+    }
 
-    def extract_code_messages(self, conv_id):
-        conv = self.get_conversation(conv_id)
-        return [(i, msg) for i, msg in enumerate(conv["messages"]) if "```" in msg["content"]]
+    def list_code_blocks(self, conv_id):
+        # Every fenced code block in the conversation, straight from the index: dicts with
+        # idx (message offset), block (its position in the message), language, start, end
+        # (character range in the message content) and code
+        try:
+            self._ensure_conversation_indexed(conv_id)
+            return self.search_index.code_blocks(conv_id)
+        except Exception as e:
+            print(f"Error listing code blocks: {str(e)}")
+            return []
 
-    def export_selected_code(self, conv_id, selected_indices):
+    def export_code_blocks(self, conv_id, keys, as_zip=False):
+        # Writes the code blocks picked by (idx, block) keys to code_exports/ in one pass,
+        # one file per block or all of them in a single zip. Returns the written paths.
         export_dir = Path("code_exports")
         export_dir.mkdir(exist_ok=True)
 
-        conv = self.get_conversation(conv_id)
-        exported = []
+        files = [(f"snippet_{code_block['idx']}_{code_block['block']}.{self._code_extension(code_block['language'])}",
+                  code_block['code'])
+                 for code_block in self.search_index.code_blocks(conv_id, keys)]
+        if as_zip:
+            import zipfile
+            path = export_dir / f"{conv_id}_code_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+            with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as archive:
+                for filename, code in files:
+                    archive.writestr(filename, code)
+            return [path]
 
-        for i in selected_indices:
-            msg = conv["messages"][i]
-            if "```" in msg["content"]:
-                start = msg["content"].find("```") + 3
-                end = msg["content"].find("```", start)
-                if end > start:
-                    lang = msg["content"][start:msg["content"].find("\n", start)].strip()
-                    code = msg["content"][msg["content"].find("\n", start):end].strip()
-
-                    filename = f"snippet_{i}.{lang}"
-                    path = export_dir / filename
-                    with open(path, 'w', encoding='utf-8') as f:
-                        f.write(code)
-                    exported.append(path)
+        exported = []
+        for filename, code in files:
+            path = export_dir / filename
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(code)
+            exported.append(path)
         return exported
 
-    def estimate_tokens(self, text):
+    def _code_extension(self, language):
+        language = language.lower()
+        return self.CODE_EXTENSIONS.get(language, language)
+
+    def store_image(self, data, mime="image/png"):
+        # Stores image bytes in the blob store and generates the thumbnail up front, so the
+        # first render of the message does not have to
+        image_ref = self.blob_store.put(data, mime)
+        self._pregenerate_thumbnail(image_ref)
+        return image_ref
+
+    def _pregenerate_thumbnail(self, image_ref):
+        try:
+            self.thumbnails.get(image_ref['hash'])
+        except Exception as e:
+            print(f"Thumbnail error: {str(e)}")
+
+    def get_thumbnail(self, msg):
+        # Thumbnail bytes for a message's image, or None if it has none or it cannot be read
+        try:
+            if msg.get('image_ref'):
+                return self.thumbnails.get(msg['image_ref']['hash'])
+            if msg.get('image_data'):
+                # Decoded once per process into the blob store, then served like any other image
+                key = hashlib.blake2b(msg['image_data'].encode('ascii'), digest_size=16).digest()
+                if key not in self._inline_image_hashes:
+                    self._inline_image_hashes[key] = self.blob_store.put(base64.b64decode(msg['image_data']))['hash']
+                return self.thumbnails.get(self._inline_image_hashes[key])
+        except Exception as e:
+            print(f"Thumbnail error: {str(e)}")
+        return None
+
+    def get_image_path(self, msg):
+        # Streamlit reads the file itself, so rendering a stored image never loads it here
+        if msg.get('image_ref'):
+            return self.blob_store.path(msg['image_ref']['hash'])
+        return None
+
+    def get_image_bytes(self, msg):
+        if msg.get('image_ref'):
+            return self.blob_store.get(msg['image_ref']['hash'])
+        if msg.get('image_data'):
+            # Inline image from a history that has not been migrated yet
+            return base64.b64decode(msg['image_data'])
+        return None
+
+    def migrate_inline_images(self):
+        # Moves base64 image_data out of every history into the blob store
+        migrated = 0
+        for conv_id in self.list_conversations():
+            # A private copy, since the messages are edited in place before the rewrite
+            conversation = self.storage.load_conversation(conv_id)
+            if not any(msg.get('image_data') for msg in conversation['messages']):
+                continue
+            for msg in conversation['messages']:
+                if msg.get('image_data'):
+                    msg['image_ref'] = self.store_image(base64.b64decode(msg.pop('image_data')), "image/png")
+                    migrated += 1
+            self.storage.rewrite_conversation(conv_id, conversation)
+            with self._cache_lock:
+                self._conversation_cache.pop(conv_id, None)
+        return migrated
+
+    def estimate_tokens(self, text, model=None):
         try:
-            return len(self.gpt_encoder.encode(str(text)))
+            return self.tokenizers.count(str(text), model)
         except Exception as e:
             print(f"Token estimation error: {e}")
             return 0
 
-    def _get_conv_path(self, conv_id):
-        return self.history_dir / f"{conv_id}.json"
-
-    def _save_conversation(self, path, conversation):
-        with open(path, 'w', encoding='utf-8') as f:
-            json.dump(conversation, f, indent=2, ensure_ascii=False)
-
-    def _load_conversation(self, path):
-        with open(path, encoding='utf-8') as f:
-            return json.load(f)
-
-    def _get_conversation_context(self, conversation, last_n=10):
-        messages = conversation['messages'][-last_n:]
-        return "\n".join([
-            f"{msg['sender']} ({msg.get('ai_service', 'user')}): {msg['content']}"
-            for msg in messages
-        ])
\ No newline at end of file
+    def estimate_tokens_batch(self, texts, model=None):
+        # Bulk recounts, encoded across tiktoken's thread pool
+        try:
+            return self.tokenizers.count_batch([str(text) for text in texts], model)
+        except Exception as e:
+            print(f"Token estimation error: {e}")
+            return [0] * len(texts)
+
+    def _context_line(self, msg):
+        return f"{msg['sender']} ({msg.get('ai_service', 'user')}): {msg['content']}"
+
+    def _get_conversation_context(self, conv_id, conversation, model=None, budget=None):
+        # Returns (context, context tokens): the newest messages that fit the model's token
+        # budget, found by walking backwards over per-message counts cached at write time.
+        # Lines and counts are kept per conversation and only extended for new messages, and
+        # the previous turn's joined text is reused when the new messages still fit after it.
+        if budget is None:
+            budget = self.CONTEXT_TOKEN_BUDGETS.get(model, self.DEFAULT_CONTEXT_BUDGET)
+        messages = conversation['messages']
+        count = len(messages)
+
+        with self._context_lock:
+            state = self._context_cache.get(conv_id)
+            known = len(state["lines"]) if state else 0
+            if state is None or known > count or (
+                    known and messages[known - 1].get('timestamp') != state["tail_timestamp"]):
+                # First use, or the history was rewritten underneath us
+                state = {"lines": [], "counts": [], "windows": {}, "tail_timestamp": None}
+                known = 0
+            new_lines = [self._context_line(msg) for msg in messages[known:]]
+            new_counts = [msg.get('context_tokens') for msg in messages[known:]]
+            # Messages saved before counts were cached are measured together in one batch
+            uncounted = [i for i, tokens in enumerate(new_counts) if tokens is None]
+            if uncounted:
+                for i, tokens in zip(uncounted, self.estimate_tokens_batch([new_lines[i] for i in uncounted])):
+                    new_counts[i] = tokens
+            state["lines"].extend(new_lines)
+            state["counts"].extend(new_counts)
+            if messages:
+                state["tail_timestamp"] = messages[-1].get('timestamp')
+            self._context_cache[conv_id] = state
+            self._context_cache.move_to_end(conv_id)
+            while len(self._context_cache) > self.CONVERSATION_CACHE_SIZE:
+                self._context_cache.popitem(last=False)
+
+            lines, counts = state["lines"], state["counts"]
+            window = state["windows"].get(budget)
+            if window and window[1] <= count:
+                start, end, context, used = window
+                added = sum(counts[end:count])
+                if used + added <= budget:
+                    context = "\n".join(([context] if end > start else []) + lines[end:count])
+                    state["windows"][budget] = (start, count, context, used + added)
+                    return context, used + added
+
+            start, used = count, 0
+            while start > 0 and used + counts[start - 1] <= budget:
+                start -= 1
+                used += counts[start]
+            context = "\n".join(lines[start:count])
+            state["windows"][budget] = (start, count, context, used)
+            return context, used
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_manager():
+    # One ChatHistoryManager per process, shared by every Streamlit session and rerun
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                with timed("init ChatHistoryManager"):
+                    _manager = ChatHistoryManager()
+    return _manager
@@ -0,0 +1,78 @@
+import re
+
+# Lines that open a function, method or type in the languages we get uploaded most (Python,
+# C#, JavaScript/TypeScript, Go, Rust, C/C++). Chunks are only cut in front of these, so each
+# chunk holds whole definitions wherever the budget allows it.
+_DEFINITION = re.compile(
+    r'^\s*(?:(?:public|private|protected|internal|static|async|export|default|override|virtual|'
+    r'abstract|sealed|partial|unsafe|inline|pub)\s+)*'
+    r'(?:def|class|struct|interface|enum|function|fn|func|impl|namespace)\b'
+    r'|^\s*(?:(?:public|private|protected|internal|static|override|virtual|abstract|async)\s+)+'
+    r'[\w<>\[\],.?]+\s+\w+\s*\('
+)
+# Decorators, attributes and comments directly above a definition belong to it
+_PREAMBLE = re.compile(r'^\s*(?:@|\[|#|//|/\*|\*)')
+
+
+def split_code(content, max_tokens, count_tokens_batch):
+    # Splits content into chunks of at most max_tokens (as measured by count_tokens_batch,
+    # which takes a list of strings), cutting on definition boundaries. A single definition
+    # larger than the budget is cut between lines.
+    segments = []
+    current = []
+    for line in content.splitlines(keepends=True):
+        if current and _DEFINITION.match(line):
+            preamble = 0
+            while preamble < len(current) and _PREAMBLE.match(current[-1 - preamble]):
+                preamble += 1
+            if preamble < len(current):
+                segments.append("".join(current[:len(current) - preamble]))
+                current = current[len(current) - preamble:]
+        current.append(line)
+    if current:
+        segments.append("".join(current))
+
+    chunks = []
+    chunk, chunk_tokens = "", 0
+    for segment, tokens in zip(segments, count_tokens_batch(segments)):
+        if tokens > max_tokens:
+            pieces = _split_lines(segment, max_tokens, count_tokens_batch)
+        else:
+            pieces = [(segment, tokens)]
+        for piece, piece_tokens in pieces:
+            if chunk and chunk_tokens + piece_tokens > max_tokens:
+                chunks.append(chunk)
+                chunk, chunk_tokens = "", 0
+            chunk += piece
+            chunk_tokens += piece_tokens
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def _split_lines(segment, max_tokens, count_tokens_batch):
+    lines = segment.splitlines(keepends=True)
+    pieces = []
+    piece, piece_tokens = "", 0
+    for line, tokens in zip(lines, count_tokens_batch(lines)):
+        if piece and piece_tokens + tokens > max_tokens:
+            pieces.append((piece, piece_tokens))
+            piece, piece_tokens = "", 0
+        piece += line
+        piece_tokens += tokens
+    if piece:
+        pieces.append((piece, piece_tokens))
+    return pieces
+
+
+# A fenced block: ``` plus an optional language, through the next line that is only a closing
+# fence. The opening fence may follow other text on its line ("Sure! ```python"), as replies
+# often put it there.
+_FENCE = re.compile(r'```[ \t]*([\w+#.-]*)[^\n`]*\n(.*?)^[ \t]*```[ \t]*$', re.MULTILINE | re.DOTALL)
+
+
+def find_code_blocks(text):
+    # [{"language", "start", "end"}] for every fenced block in text, where text[start:end] is
+    # the code between the fences
+    return [{"language": match.group(1), "start": match.start(2), "end": match.end(2)}
+            for match in _FENCE.finditer(text)]
@@ -0,0 +1,92 @@
+import base64
+import json
+import shutil
+
+
+class ConversationExporter:
+    # Streams a conversation out as JSON, NDJSON, Markdown or plain text. Messages are read
+    # and written one at a time, so memory stays flat however long the conversation is.
+    # Images are not inlined: when an image directory is given each one is written there as
+    # its own file and the export refers to it by relative path; otherwise the export keeps
+    # just the blob reference.
+
+    FORMATS = {
+        "json": "application/json",
+        "ndjson": "application/x-ndjson",
+        "md": "text/markdown",
+        "txt": "text/plain"
+    }
+    EXTENSIONS = {"image/png": "png", "image/jpeg": "jpg", "image/gif": "gif", "image/webp": "webp"}
+    # Bookkeeping the app stores on each message for itself, left out of exports
+    INTERNAL_FIELDS = ("context_tokens", "code_blocks")
+
+    def __init__(self, blob_store):
+        self.blob_store = blob_store
+
+    def chunks(self, header, messages, format="json", image_dir=None):
+        # Yields the export as text chunks. header holds the conversation's title and
+        # created_at; messages may be any iterable, such as storage.iter_messages.
+        if format not in self.FORMATS:
+            raise ValueError(f"Unknown export format: {format}")
+        messages = (self._export_message(idx, msg, image_dir) for idx, msg in enumerate(messages))
+
+        if format == "json":
+            head = json.dumps(header, indent=2, ensure_ascii=False)
+            yield (head[:-2] + ",\n" if header else "{\n") + '  "messages": ['
+            for n, msg in enumerate(messages):
+                body = json.dumps(msg, indent=2, ensure_ascii=False).replace("\n", "\n    ")
+                yield ("," if n else "") + "\n    " + body
+            yield "\n  ]\n}\n"
+
+        elif format == "ndjson":
+            # Same layout as the message logs: a header line, then one message per line
+            yield json.dumps(header, ensure_ascii=False) + "\n"
+            for msg in messages:
+                yield json.dumps(msg, ensure_ascii=False) + "\n"
+
+        elif format == "md":
+            yield f"# {header.get('title', '')}\n\n_Created {header.get('created_at', '')}_\n\n"
+            for msg in messages:
+                who = " · ".join(part for part in (msg.get('sender'), msg.get('ai_service'), msg.get('model')) if part)
+                chunk = f"### {who}\n\n"
+                if msg.get('timestamp'):
+                    chunk += f"_{msg['timestamp']}_\n\n"
+                chunk += f"{msg.get('content', '')}\n\n"
+                if msg.get('image_file'):
+                    chunk += f"![image]({msg['image_file']})\n\n"
+                yield chunk
+
+        else:
+            for msg in messages:
+                ai_service = f"[{msg.get('ai_service', 'user')}]" if msg.get('ai_service') else ""
+                chunk = f"{msg['sender']} {ai_service}: {msg['content']}\n\n"
+                if msg.get('image_file'):
+                    chunk += f"[image: {msg['image_file']}]\n\n"
+                yield chunk
+
+    def write(self, path, header, messages, format="json"):
+        # Writes the export to path, with images in a <name>_images directory beside it
+        image_dir = path.parent / f"{path.stem}_images"
+        with open(path, 'w', encoding='utf-8') as f:
+            for chunk in self.chunks(header, messages, format, image_dir):
+                f.write(chunk)
+        return path
+
+    def _export_message(self, idx, msg, image_dir):
+        msg = {key: value for key, value in msg.items() if key not in self.INTERNAL_FIELDS}
+        if not (msg.get('image_ref') or msg.get('image_data')):
+            return msg
+        image_data = msg.pop('image_data', None)
+        if image_dir is None:
+            return msg
+
+        mime = msg.get('image_ref', {}).get('mime', "image/png")
+        image_path = image_dir / f"image_{idx}.{self.EXTENSIONS.get(mime, 'png')}"
+        image_dir.mkdir(parents=True, exist_ok=True)
+        if msg.get('image_ref'):
+            shutil.copyfile(self.blob_store.path(msg['image_ref']['hash']), image_path)
+        else:
+            with open(image_path, 'wb') as f:
+                f.write(base64.b64decode(image_data))
+        msg['image_file'] = f"{image_dir.name}/{image_path.name}"
+        return msg
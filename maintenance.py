@@ -0,0 +1,66 @@
+import argparse
+
+from chat_manager import get_manager
+from storage import copy_conversations, create_storage
+
+
+def migrate_images(manager, args):
+    migrated = manager.migrate_inline_images()
+    print(f"Moved {migrated} inline images into {manager.blob_store.root}")
+
+
+def repair_tokens(manager, args):
+    repaired = manager.repair_token_rollups()
+    print(f"Recomputed token rollups for {repaired} conversations")
+
+
+def prune_analysis_cache(manager, args):
+    removed = manager.analysis_cache.prune()
+    print(f"Removed {removed} expired or over-budget analyses from {manager.analysis_cache.root}")
+
+
+def import_analysis_log(manager, args):
+    imported = manager.analysis_log.import_text_log(args.path)
+    print(f"Imported {imported} analyses from {args.path} into {manager.analysis_log.db_path}")
+
+
+def rebuild_search_index(manager, args):
+    indexed = manager.rebuild_search_index()
+    print(f"Reindexed {indexed} conversations into {manager.search_index.db_path}")
+
+
+def copy_storage(manager, args):
+    # Copies from the backend CHAT_STORAGE currently selects into the other one; set
+    # CHAT_STORAGE to the new backend afterwards
+    target = create_storage(args.to, manager.history_dir)
+    if type(target) is type(manager.storage):
+        print(f"Conversations are already stored in {args.to}; set CHAT_STORAGE to the backend to copy from")
+        return
+    copied = copy_conversations(manager.storage, target)
+    print(f"Copied {copied} conversations into {args.to} storage; set CHAT_STORAGE={args.to} to use it")
+
+
+COMMANDS = {
+    "migrate-images": (migrate_images, "move base64 image_data out of history files into the blob store"),
+    "repair-tokens": (repair_tokens, "recompute message counts and token rollups for every conversation"),
+    "prune-analysis-cache": (prune_analysis_cache, "evict expired and least recently used code analyses"),
+    "import-analysis-log": (import_analysis_log, "load file_analysis_log.txt entries into the analysis log"),
+    "rebuild-search-index": (rebuild_search_index, "reindex every conversation for message search"),
+    "copy-storage": (copy_storage, "copy every conversation into another storage backend"),
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintenance jobs for chat histories")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, (_, help_text) in COMMANDS.items():
+        subparsers.add_parser(name, help=help_text)
+    subparsers.choices["import-analysis-log"].add_argument("path", nargs="?", default="file_analysis_log.txt")
+    subparsers.choices["copy-storage"].add_argument("--to", choices=["file", "sqlite"], required=True)
+
+    args = parser.parse_args()
+    COMMANDS[args.command][0](get_manager(), args)
+
+
+if __name__ == "__main__":
+    main()
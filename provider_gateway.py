@@ -0,0 +1,270 @@
+import asyncio
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+
+class ProviderUnavailableError(Exception):
+    # Raised without calling the provider while its circuit breaker is open
+    pass
+
+
+class TokenBucket:
+    # Allows per_minute units a minute, refilled continuously, with bursts of up to a full
+    # minute's worth. reserve takes the units straight away, going into debt if needed, and
+    # returns how long the caller should wait for the debt to be repaid; concurrent callers
+    # therefore queue up fairly without polling.
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount):
+        with self._lock:
+            self._refill()
+            self.level -= min(amount, self.capacity)
+            return max(0.0, -self.level / self.rate)
+
+    def adjust(self, amount):
+        # Corrects an earlier reservation once the real cost is known (negative gives units back)
+        with self._lock:
+            self._refill()
+            self.level = min(self.capacity, self.level - amount)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class CircuitBreaker:
+    # Opens after FAILURE_THRESHOLD consecutive failures, rejecting calls for RESET_SECONDS.
+    # Then one trial call is let through (half-open): success closes the circuit again and
+    # failure reopens it.
+
+    FAILURE_THRESHOLD = 5
+    RESET_SECONDS = 30
+
+    def __init__(self):
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def before_call(self, provider):
+        with self._lock:
+            if self.state == "open":
+                remaining = self.RESET_SECONDS - (time.monotonic() - self.opened_at)
+                if remaining > 0:
+                    raise ProviderUnavailableError(
+                        f"{provider} is temporarily unavailable after repeated failures; retry in {remaining:.0f}s")
+                self.state = "half-open"
+            if self.state == "half-open":
+                if self._trial_running:
+                    raise ProviderUnavailableError(f"{provider} is recovering; a trial request is in flight")
+                self._trial_running = True
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half-open" or self.failures >= self.FAILURE_THRESHOLD:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+            self._trial_running = False
+
+
+class ProviderGateway:
+    # Every provider call goes through here. Per provider it applies token-bucket limits on
+    # requests and tokens per minute, retries rate-limit, overload, timeout and connection
+    # errors with jittered exponential backoff (or exactly the wait the provider asks for in
+    # retry-after), and trips a circuit breaker so calls fail fast while a provider keeps
+    # failing. Other errors, such as a bad request, are raised straight away.
+
+    LIMITS = {
+        "claude": {"requests_per_minute": 50, "tokens_per_minute": 40000},
+        "chatgpt": {"requests_per_minute": 60, "tokens_per_minute": 60000},
+        "gemini": {"requests_per_minute": 60, "tokens_per_minute": 32000},
+        "dalle": {"requests_per_minute": 5, "tokens_per_minute": None}
+    }
+    MAX_RETRIES = 4
+    BASE_DELAY_SECONDS = 1.0
+    MAX_DELAY_SECONDS = 30.0
+    RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+    def __init__(self, limits=None):
+        self.limits = {**self.LIMITS, **(limits or {})}
+        self._providers = {}
+        self._lock = threading.Lock()
+
+    def call(self, provider, request, tokens=0):
+        # Runs request() under the provider's limits, retrying it when that may help
+        state = self._provider(provider)
+        attempt = 0
+        while True:
+            # Tokens are reserved once per call; a rejected attempt used none of them
+            time.sleep(self._admit(provider, state, 0 if attempt else tokens))
+            try:
+                result = request()
+            except Exception as e:
+                delay = self._after_failure(state, e, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                time.sleep(delay)
+                continue
+            self._after_success(state)
+            return result
+
+    async def call_async(self, provider, request, tokens=0):
+        # call for coroutines: request() returns an awaitable, and waits do not block the loop
+        state = self._provider(provider)
+        attempt = 0
+        while True:
+            await asyncio.sleep(self._admit(provider, state, 0 if attempt else tokens))
+            try:
+                result = await request()
+            except Exception as e:
+                delay = self._after_failure(state, e, attempt)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            self._after_success(state)
+            return result
+
+    @contextmanager
+    def guard(self, provider, tokens=0):
+        # Limits and circuit breaking without retries, for streamed replies: once text has
+        # been shown, a retry would repeat it
+        state = self._provider(provider)
+        time.sleep(self._admit(provider, state, tokens))
+        failure = None
+        try:
+            yield
+        except Exception as e:
+            failure = e
+            raise
+        finally:
+            if failure is None:
+                self._after_success(state)
+            elif self._retryable(failure):
+                self._record_failure(state)
+            else:
+                # As in call: the provider answered, so only a trial call is released
+                state["breaker"].record_success()
+
+    def adjust_tokens(self, provider, tokens):
+        # Settles the token bucket once a call's real usage is known: tokens is the actual
+        # count minus what was reserved
+        bucket = self._provider(provider)["tokens"]
+        if bucket and tokens:
+            bucket.adjust(tokens)
+
+    def stats(self):
+        with self._lock:
+            providers = dict(self._providers)
+        return {provider: {**state["stats"], "circuit": state["breaker"].state}
+                for provider, state in providers.items()}
+
+    def format_stats(self):
+        lines = [f"{'provider':<8} {'calls':>6} {'ok':>5} {'retry':>5} {'fail':>5} {'reject':>6} "
+                 f"{'waited':>8}  circuit"]
+        for provider, stats in sorted(self.stats().items()):
+            lines.append(f"{provider:<8} {stats['calls']:>6} {stats['succeeded']:>5} {stats['retries']:>5} "
+                         f"{stats['failures']:>5} {stats['rejected']:>6} {stats['waited_seconds']:>7.1f}s  "
+                         f"{stats['circuit']}")
+        return "\n".join(lines)
+
+    def _provider(self, provider):
+        with self._lock:
+            if provider not in self._providers:
+                limits = self.limits.get(provider, {})
+                self._providers[provider] = {
+                    "requests": TokenBucket(limits["requests_per_minute"])
+                    if limits.get("requests_per_minute") else None,
+                    "tokens": TokenBucket(limits["tokens_per_minute"]) if limits.get("tokens_per_minute") else None,
+                    "breaker": CircuitBreaker(),
+                    "stats": {"calls": 0, "succeeded": 0, "retries": 0, "failures": 0, "rejected": 0,
+                              "waited_seconds": 0.0}
+                }
+            return self._providers[provider]
+
+    def _admit(self, provider, state, tokens):
+        # Checks the breaker and reserves from the buckets; returns how long to wait first
+        try:
+            state["breaker"].before_call(provider)
+        except ProviderUnavailableError:
+            self._count(state, "rejected")
+            raise
+        wait = 0.0
+        if state["requests"]:
+            wait = state["requests"].reserve(1)
+        if state["tokens"] and tokens:
+            wait = max(wait, state["tokens"].reserve(tokens))
+        self._count(state, "calls")
+        self._count(state, "waited_seconds", wait)
+        return wait
+
+    def _after_success(self, state):
+        state["breaker"].record_success()
+        self._count(state, "succeeded")
+
+    def _after_failure(self, state, error, attempt):
+        # Seconds to wait before retrying, or None when the error should be raised now
+        if not self._retryable(error):
+            # The provider answered, so it is not degraded; this only releases a trial call
+            state["breaker"].record_success()
+            return None
+        self._record_failure(state)
+        if attempt >= self.MAX_RETRIES or state["breaker"].state == "open":
+            return None
+        self._count(state, "retries")
+        retry_after = self._retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.MAX_DELAY_SECONDS)
+        return random.uniform(0, min(self.MAX_DELAY_SECONDS, self.BASE_DELAY_SECONDS * 2 ** attempt))
+
+    def _record_failure(self, state):
+        state["breaker"].record_failure()
+        self._count(state, "failures")
+
+    def _count(self, state, key, amount=1):
+        with self._lock:
+            state["stats"][key] += amount
+
+    def _retryable(self, error):
+        # Status codes from the OpenAI and Anthropic SDKs (status_code) and Google API errors
+        # (code); timeouts and dropped connections are recognized by type name, so no SDK has
+        # to be imported here
+        status = getattr(error, "status_code", None) or getattr(error, "code", None)
+        if isinstance(status, int):
+            return status in self.RETRY_STATUS_CODES
+        return isinstance(error, (TimeoutError, ConnectionError)) or any(
+            name in type(error).__name__ for name in ("Timeout", "Connection", "ResourceExhausted", "Unavailable"))
+
+    def _retry_after(self, error):
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None)
+        if not headers:
+            return None
+        try:
+            if headers.get("retry-after-ms"):
+                return float(headers["retry-after-ms"]) / 1000
+            if headers.get("retry-after"):
+                return float(headers["retry-after"])
+        except ValueError:
+            # An HTTP date rather than a number of seconds; fall back to backoff
+            pass
+        return None
@@ -0,0 +1,172 @@
+import re
+
+from code_chunks import find_code_blocks
+from storage import SQLiteDatabase
+
+
+class SearchIndex(SQLiteDatabase):
+    # Full-text index over message content, kept in its own SQLite database (FTS5) so it works
+    # the same with either storage backend. Each row points back at a message by conversation
+    # and offset. indexed_counts records how many messages of each conversation are indexed;
+    # new messages are added incrementally as they are appended, and a conversation whose
+    # count no longer lines up with storage is reindexed in full. The meta table records when
+    # every stored conversation has been indexed, since appends alone only ever cover the
+    # conversations they touch. The fenced code blocks of each message are indexed alongside,
+    # with their code, so listing and exporting them never touches the conversation itself.
+
+    # Bumped whenever find_code_blocks recognizes blocks it used to miss, so existing indexes
+    # are rebuilt with them
+    CODE_BLOCK_FORMAT = "2"
+
+    SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS message_text USING fts5 (
+            content,
+            conv_id UNINDEXED,
+            idx UNINDEXED,
+            sender UNINDEXED,
+            ai_service UNINDEXED,
+            model UNINDEXED,
+            tokenize = 'unicode61 remove_diacritics 2'
+        );
+        CREATE TABLE IF NOT EXISTS indexed_counts (
+            conv_id TEXT PRIMARY KEY,
+            message_count INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS code_blocks (
+            conv_id TEXT NOT NULL,
+            idx INTEGER NOT NULL,
+            block INTEGER NOT NULL,
+            language TEXT,
+            start_offset INTEGER NOT NULL,
+            end_offset INTEGER NOT NULL,
+            code TEXT NOT NULL,
+            PRIMARY KEY (conv_id, idx, block)
+        );
+    """
+
+    def __init__(self, db_path):
+        super().__init__(db_path)
+        conn = self._connect()
+        had_code_blocks = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'code_blocks'").fetchone()
+        conn.executescript(self.SCHEMA)
+        code_block_format = conn.execute("SELECT value FROM meta WHERE key = 'code_block_format'").fetchone()
+        if not had_code_blocks or code_block_format != (self.CODE_BLOCK_FORMAT,):
+            # Indexes built before code blocks were tracked, or with an older parser, are
+            # dropped and rebuilt on next use
+            with self._transaction() as conn:
+                conn.execute("DELETE FROM message_text")
+                conn.execute("DELETE FROM code_blocks")
+                conn.execute("DELETE FROM indexed_counts")
+                conn.execute("DELETE FROM meta WHERE key = 'fully_built'")
+                conn.execute("INSERT INTO meta (key, value) VALUES ('code_block_format', ?) "
+                             "ON CONFLICT (key) DO UPDATE SET value = excluded.value", (self.CODE_BLOCK_FORMAT,))
+
+    def indexed_count(self, conv_id):
+        row = self._connect().execute(
+            "SELECT message_count FROM indexed_counts WHERE conv_id = ?", (conv_id,)).fetchone()
+        return row[0] if row else 0
+
+    def is_built(self):
+        # True once mark_built has recorded a full build of every conversation
+        return self._connect().execute("SELECT 1 FROM meta WHERE key = 'fully_built'").fetchone() is not None
+
+    def mark_built(self):
+        self._connect().execute(
+            "INSERT INTO meta (key, value) VALUES ('fully_built', datetime('now')) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value"
+        )
+
+    def add_messages(self, conv_id, start, messages):
+        # Indexes messages stored at offsets start, start + 1, ... Returns False without
+        # writing anything when the index does not hold exactly the start messages before
+        # them, in which case the caller should reindex the conversation.
+        with self._transaction() as conn:
+            row = conn.execute("SELECT message_count FROM indexed_counts WHERE conv_id = ?", (conv_id,)).fetchone()
+            if (row[0] if row else 0) != start:
+                return False
+            self._insert(conn, conv_id, start, messages)
+            return True
+
+    def index_conversation(self, conv_id, messages):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM message_text WHERE conv_id = ?", (conv_id,))
+            conn.execute("DELETE FROM code_blocks WHERE conv_id = ?", (conv_id,))
+            conn.execute("DELETE FROM indexed_counts WHERE conv_id = ?", (conv_id,))
+            self._insert(conn, conv_id, 0, messages)
+
+    def _insert(self, conn, conv_id, start, messages):
+        conn.executemany(
+            "INSERT INTO message_text (content, conv_id, idx, sender, ai_service, model) VALUES (?, ?, ?, ?, ?, ?)",
+            [(str(msg.get('content', '')), conv_id, start + n, msg.get('sender'), msg.get('ai_service'),
+              msg.get('model'))
+             for n, msg in enumerate(messages)]
+        )
+        # Ranges come from the message when they were recorded at write time, and are parsed
+        # here for messages saved before that, or recorded without blocks by an older parser
+        conn.executemany(
+            "INSERT INTO code_blocks (conv_id, idx, block, language, start_offset, end_offset, code) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(conv_id, start + n, block, code_block["language"], code_block["start"], code_block["end"],
+              str(msg.get('content', ''))[code_block["start"]:code_block["end"]])
+             for n, msg in enumerate(messages)
+             for block, code_block in enumerate(self._code_blocks(msg))]
+        )
+        conn.execute(
+            "INSERT INTO indexed_counts (conv_id, message_count) VALUES (?, ?) "
+            "ON CONFLICT (conv_id) DO UPDATE SET message_count = excluded.message_count",
+            (conv_id, start + len(messages))
+        )
+
+    def _code_blocks(self, msg):
+        content = str(msg.get('content', ''))
+        if msg.get('code_blocks') or ('code_blocks' in msg and '```' not in content):
+            return msg['code_blocks']
+        return find_code_blocks(content)
+
+    def code_blocks(self, conv_id, keys=None):
+        # Code blocks of a conversation in message order as dicts with idx, block, language,
+        # start, end and code; keys limits them to the given (idx, block) pairs
+        rows = self._connect().execute(
+            "SELECT idx, block, language, start_offset, end_offset, code FROM code_blocks WHERE conv_id = ? ORDER BY idx, block",
+            (conv_id,)
+        )
+        columns = ("idx", "block", "language", "start", "end", "code")
+        blocks = [dict(zip(columns, row)) for row in rows]
+        if keys is not None:
+            keys = set(keys)
+            blocks = [code_block for code_block in blocks if (code_block["idx"], code_block["block"]) in keys]
+        return blocks
+
+    def search(self, query, ai_service=None, model=None, limit=50):
+        # Best matches first as dicts with conv_id, idx (the message offset), sender,
+        # ai_service, model and a highlighted snippet. Every word in query must match;
+        # the last one also matches as a prefix, so results show up while typing.
+        match = self._match_expression(query)
+        if not match:
+            return []
+        sql = ("SELECT conv_id, idx, sender, ai_service, model, "
+               "snippet(message_text, 0, '**', '**', '…', 16) FROM message_text WHERE message_text MATCH ?")
+        params = [match]
+        if ai_service:
+            sql += " AND ai_service = ?"
+            params.append(ai_service)
+        if model:
+            sql += " AND model = ?"
+            params.append(model)
+        sql += " ORDER BY rank LIMIT ?"
+        params.append(limit)
+        columns = ("conv_id", "idx", "sender", "ai_service", "model", "snippet")
+        return [dict(zip(columns, row)) for row in self._connect().execute(sql, params)]
+
+    def _match_expression(self, query):
+        # Each word is quoted so FTS5 operators and punctuation in user input are taken literally
+        words = re.findall(r'\w+', query)
+        if not words:
+            return ""
+        terms = [f'"{word}"' for word in words]
+        terms[-1] += "*"
+        return " ".join(terms)
@@ -0,0 +1,36 @@
+import threading
+import time
+from contextlib import contextmanager
+
+# Wall-clock cost of each import and one-time initialization step, recorded the first time
+# the step runs in this process. Streamlit re-executes app.py on every rerun, but modules and
+# clients are only loaded once, so the first measurement is the cold-start cost.
+_timings = {}
+_lock = threading.Lock()
+_process_start = time.perf_counter()
+
+
+@contextmanager
+def timed(label):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            _timings.setdefault(label, (start - _process_start, elapsed))
+
+
+def startup_report():
+    # [(label, seconds since process start, duration in seconds)] in the order the steps ran
+    with _lock:
+        steps = [(label, started, elapsed) for label, (started, elapsed) in _timings.items()]
+    return sorted(steps, key=lambda step: step[1])
+
+
+def format_startup_report():
+    lines = [f"{label:<32} {elapsed * 1000:8.1f} ms  (at +{started * 1000:.0f} ms)"
+             for label, started, elapsed in startup_report()]
+    total = sum(elapsed for _, _, elapsed in startup_report())
+    lines.append(f"{'total':<32} {total * 1000:8.1f} ms")
+    return "\n".join(lines)
@@ -0,0 +1,618 @@
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+
+class FileStorage:
+    # One append-only message log per conversation: a header record on the first line
+    # followed by one message per line. Older histories are a single JSON document and
+    # are still read as-is until their next write.
+    #
+    # A manifest (conversations.index) keeps one summary per conversation so listing does
+    # not have to parse every history. It is itself append-only: each create or append
+    # writes the updated summary as a new line, the last line for a conversation wins, and
+    # the file is compacted once superseded lines pile up. Every summary records the size
+    # and mtime of the history it describes, so histories written by another process (or a
+    # missing manifest) are detected on listing and only the new tail of the log is read.
+    # Summaries also carry the conversation's token rollups per service, model and sender.
+
+    INDEX_FILE = "conversations.index"
+    # Bytes read per step when loading the tail of a message log
+    TAIL_BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, history_dir):
+        self.history_dir = Path(history_dir)
+        self.history_dir.mkdir(exist_ok=True)
+        self.index_path = self.history_dir / self.INDEX_FILE
+        self._index = None
+        self._index_lines = 0
+        # (size, mtime_ns) of the manifest as of the parsed index, to spot other writers
+        self._index_stat = None
+        self._lock = threading.RLock()
+
+    def create_conversation(self, conv_id, header):
+        conv_path = self.history_dir / f"{conv_id}.jsonl"
+        self._save_conversation(conv_path, {**header, "messages": []})
+        with self._lock:
+            entry = self._new_summary(conv_id, header)
+            self._store_summary(entry, conv_path)
+
+    def append_messages(self, conv_id, messages):
+        with self._lock:
+            conv_path = self._get_conv_path(conv_id)
+            if conv_path.suffix == ".json":
+                # One-time conversion of a legacy history; every later write is a plain append
+                conversation = self._load_conversation(conv_path)
+                conversation["messages"].extend(messages)
+                log_path = conv_path.with_suffix(".jsonl")
+                self._save_conversation(log_path, conversation)
+                conv_path.unlink()
+                self._store_summary(self._summarize(conv_id, conversation), log_path)
+                return
+
+            stat_before = conv_path.stat()
+            data = "".join(json.dumps(message, ensure_ascii=False) + "\n" for message in messages).encode('utf-8')
+            with open(conv_path, 'ab') as f:
+                f.write(data)
+            stat_after = conv_path.stat()
+
+            # Only this writer's bytes landed between the two stats when the size grew by
+            # exactly what it wrote; otherwise the summary is rebuilt from the log itself
+            uncontended = stat_after.st_size == stat_before.st_size + len(data)
+            entry = self._get_index().get(conv_id)
+            if uncontended and entry is not None and entry["size"] == stat_before.st_size:
+                self._fold_messages(entry, messages)
+                # Stamped with the stat taken right after the write, so a later append by
+                # another process is still seen as new
+                entry["size"] = stat_after.st_size
+                entry["mtime_ns"] = stat_after.st_mtime_ns
+                self._write_summary(entry)
+            else:
+                self._refresh_summary(conv_id, conv_path, stat_after)
+
+            # (version before, version after) of the history, so callers holding a parsed copy
+            # can extend it instead of reloading. None when another writer got in between.
+            if not uncontended:
+                return None
+            return ((stat_before.st_size, stat_before.st_mtime_ns), (stat_after.st_size, stat_after.st_mtime_ns))
+
+    def load_conversation(self, conv_id):
+        return self._load_conversation(self._get_conv_path(conv_id))
+
+    def iter_messages(self, conv_id):
+        # Messages one at a time, for readers such as exports that should not hold the whole
+        # history in memory
+        conv_path = self._get_conv_path(conv_id)
+        if conv_path.suffix == ".json":
+            yield from self._load_conversation(conv_path)["messages"]
+            return
+        with open(conv_path, encoding='utf-8') as f:
+            f.readline()
+            yield from self._read_messages(f, conv_path)
+
+    def load_tail(self, conv_id, count):
+        # The last count messages and the offset of the first of them, reading the message
+        # log backwards from the end instead of parsing the whole history. The summary
+        # pins the byte length and message count together, so an append landing meanwhile
+        # is simply not seen yet.
+        conv_path = self._get_conv_path(conv_id)
+        if conv_path.suffix == ".json":
+            messages = self._load_conversation(conv_path)["messages"]
+            start = max(len(messages) - count, 0)
+            return messages[start:], start
+
+        summary = self.get_summary(conv_id)
+        pos = summary["size"]
+        data = b""
+        with open(conv_path, 'rb') as f:
+            # Stop once the buffer holds count complete lines past the first, possibly partial, one
+            while pos > 0 and data.count(b"\n") <= count + 1:
+                step = min(self.TAIL_BLOCK_SIZE, pos)
+                pos -= step
+                f.seek(pos)
+                data = f.read(step) + data
+
+        messages = []
+        # The first line is either the header or cut partway through
+        for line in data.split(b"\n")[1:]:
+            if not line.strip():
+                continue
+            try:
+                messages.append(json.loads(line))
+            except json.JSONDecodeError:
+                print(f"Skipping unreadable message record in {conv_path}")
+        messages = messages[-count:] if count else []
+        return messages, summary["message_count"] - len(messages)
+
+    def conversation_version(self, conv_id):
+        # Changes whenever the history is written, by this process or any other
+        try:
+            stat = self._get_conv_path(conv_id).stat()
+        except FileNotFoundError:
+            return None
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def rewrite_conversation(self, conv_id, conversation):
+        # Full rewrite for maintenance jobs such as migrations; normal writes only append
+        with self._lock:
+            conv_path = self._get_conv_path(conv_id)
+            log_path = self.history_dir / f"{conv_id}.jsonl"
+            self._save_conversation(log_path, conversation)
+            if conv_path != log_path:
+                conv_path.unlink()
+            self._store_summary(self._summarize(conv_id, conversation), log_path)
+
+    def list_conversations(self):
+        return [entry["conv_id"] for entry in self.list_conversation_summaries()]
+
+    def list_conversation_summaries(self):
+        with self._lock:
+            # Re-read the manifest only when another process has written to it since
+            if self._manifest_stat() != self._index_stat:
+                self._index = None
+            index = self._get_index()
+
+            # Get all conversation files, preferring the message log over a legacy JSON file
+            conv_files = {}
+            for file in os.scandir(self.history_dir):
+                stem, ext = os.path.splitext(file.name)
+                if ext == ".jsonl" or (ext == ".json" and stem not in conv_files):
+                    conv_files[stem] = file
+
+            for conv_id, file in conv_files.items():
+                stat = file.stat()
+                entry = index.get(conv_id)
+                if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+                    try:
+                        self._refresh_summary(conv_id, Path(file.path), stat)
+                    except Exception as e:
+                        print(f"Error reading conversation {file.path}: {e}")
+
+            removed = [conv_id for conv_id in index if conv_id not in conv_files]
+            for conv_id in removed:
+                del index[conv_id]
+            if removed or self._index_lines > 2 * len(index) + 64:
+                self._compact_index()
+
+            # Sort by creation time in descending order (newest first)
+            return sorted(index.values(), key=lambda entry: entry["created_at"], reverse=True)
+
+    def get_summary(self, conv_id):
+        with self._lock:
+            conv_path = self._get_conv_path(conv_id)
+            stat = conv_path.stat()
+            entry = self._get_index().get(conv_id)
+            if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+                self._refresh_summary(conv_id, conv_path, stat)
+                entry = self._index[conv_id]
+            return entry
+
+    def rebuild_summaries(self):
+        # Recomputes every summary from the histories themselves
+        with self._lock:
+            self.index_path.unlink(missing_ok=True)
+            return len(self.list_conversation_summaries())
+
+    def _get_conv_path(self, conv_id):
+        log_path = self.history_dir / f"{conv_id}.jsonl"
+        legacy_path = self.history_dir / f"{conv_id}.json"
+        if not log_path.exists() and legacy_path.exists():
+            return legacy_path
+        return log_path
+
+    def _save_conversation(self, path, conversation):
+        header = {key: value for key, value in conversation.items() if key != "messages"}
+        tmp_path = path.with_suffix(".jsonl.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(header, ensure_ascii=False) + "\n")
+            for message in conversation["messages"]:
+                f.write(json.dumps(message, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, path)
+
+    def _load_conversation(self, path):
+        if path.suffix == ".json":
+            with open(path, encoding='utf-8') as f:
+                return json.load(f)
+
+        with open(path, encoding='utf-8') as f:
+            conversation = json.loads(f.readline())
+            conversation["messages"] = list(self._read_messages(f, path))
+        return conversation
+
+    def _read_messages(self, lines, path):
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # A torn final line from an interrupted append; the rest of the log is intact
+                print(f"Skipping unreadable message record in {path}")
+
+    def _get_index(self):
+        if self._index is None:
+            self._index = {}
+            self._index_lines = 0
+            self._index_stat = self._manifest_stat()
+            if self.index_path.exists():
+                with open(self.index_path, encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except json.JSONDecodeError:
+                            continue
+                        self._index_lines += 1
+                        # Summaries written before token rollups existed are rebuilt on listing
+                        if "token_rollups" in entry:
+                            self._index[entry["conv_id"]] = entry
+                        else:
+                            self._index.pop(entry["conv_id"], None)
+        return self._index
+
+    def _store_summary(self, entry, conv_path):
+        stat = conv_path.stat()
+        entry["size"] = stat.st_size
+        entry["mtime_ns"] = stat.st_mtime_ns
+        self._write_summary(entry)
+
+    def _write_summary(self, entry):
+        self._get_index()[entry["conv_id"]] = entry
+        up_to_date = self._manifest_stat() == self._index_stat
+        with open(self.index_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._index_lines += 1
+        # Our own append keeps the index current unless someone else had written first
+        self._index_stat = self._manifest_stat() if up_to_date else None
+
+    def _compact_index(self):
+        tmp_path = self.index_path.with_suffix(".index.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in self._index.values():
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.index_path)
+        self._index_lines = len(self._index)
+        self._index_stat = self._manifest_stat()
+
+    def _manifest_stat(self):
+        try:
+            stat = self.index_path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def _refresh_summary(self, conv_id, conv_path, stat):
+        entry = self._get_index().get(conv_id)
+        if conv_path.suffix == ".jsonl" and entry is not None and 0 < entry["size"] <= stat.st_size:
+            # The log only ever grows, so fold in just the records written since the summary
+            with open(conv_path, 'rb') as f:
+                f.seek(entry["size"])
+                tail = f.read()
+            complete = tail[:tail.rfind(b"\n") + 1]
+            messages = []
+            for line in complete.splitlines():
+                try:
+                    messages.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+            self._fold_messages(entry, messages)
+            entry["size"] += len(complete)
+            entry["mtime_ns"] = stat.st_mtime_ns
+        else:
+            entry = self._summarize(conv_id, self._load_conversation(conv_path))
+            entry["size"] = stat.st_size
+            entry["mtime_ns"] = stat.st_mtime_ns
+        self._write_summary(entry)
+
+    def _new_summary(self, conv_id, header):
+        created_at = header.get("created_at", "2000-01-01T00:00:00")
+        return {
+            "conv_id": conv_id,
+            "title": header.get("title", conv_id),
+            "created_at": created_at,
+            "last_activity": created_at,
+            "message_count": 0,
+            "total_tokens": 0,
+            "token_rollups": {"by_service": {}, "by_model": {}, "by_sender": {}}
+        }
+
+    def _summarize(self, conv_id, conversation):
+        entry = self._new_summary(conv_id, conversation)
+        self._fold_messages(entry, conversation["messages"])
+        return entry
+
+    def _fold_messages(self, entry, messages):
+        rollups = entry["token_rollups"]
+        for message in messages:
+            entry["message_count"] += 1
+            entry["last_activity"] = message.get("timestamp") or entry["last_activity"]
+            for keys, tokens in _token_counts(message):
+                entry["total_tokens"] += tokens
+                for dimension, key in zip(ROLLUP_DIMENSIONS, keys):
+                    rollups[dimension][key] = rollups[dimension].get(key, 0) + tokens
+
+
+class SQLiteDatabase:
+    # Base for the SQLite-backed stores (conversations, the analysis log and the search
+    # index). sqlite3 connections must stay on the thread that opened them, and Streamlit
+    # runs each session on its own thread, so each thread gets its own connection. WAL mode
+    # lets readers carry on while another thread or process writes.
+
+    PRAGMAS = ("journal_mode=WAL", "synchronous=NORMAL")
+    ROW_FACTORY = None
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(exist_ok=True)
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            if self.ROW_FACTORY:
+                conn.row_factory = self.ROW_FACTORY
+            for pragma in self.PRAGMAS:
+                conn.execute(f"PRAGMA {pragma}")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        # Takes the write lock up front, so a read-then-write inside cannot be interleaved
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+
+class SQLiteStorage(SQLiteDatabase):
+    # All conversations in one SQLite database. WAL mode lets readers in other Streamlit
+    # sessions keep going while one session writes, and every operation is a single
+    # indexed query instead of a full-file parse and rewrite.
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversations (
+            conv_id TEXT PRIMARY KEY,
+            title TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            header TEXT NOT NULL,
+            last_activity TEXT,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            total_tokens INTEGER NOT NULL DEFAULT 0,
+            version INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_conversations_created_at ON conversations (created_at);
+
+        CREATE TABLE IF NOT EXISTS messages (
+            conv_id TEXT NOT NULL REFERENCES conversations (conv_id),
+            idx INTEGER NOT NULL,
+            sender TEXT,
+            ai_service TEXT,
+            model TEXT,
+            tokens INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT,
+            data TEXT NOT NULL,
+            PRIMARY KEY (conv_id, idx)
+        );
+        CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages (conv_id, created_at);
+
+        CREATE TABLE IF NOT EXISTS token_counts (
+            conv_id TEXT NOT NULL REFERENCES conversations (conv_id),
+            ai_service TEXT NOT NULL,
+            model TEXT NOT NULL,
+            sender TEXT NOT NULL,
+            tokens INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (conv_id, ai_service, model, sender)
+        );
+    """
+
+    PRAGMAS = SQLiteDatabase.PRAGMAS + ("foreign_keys=ON",)
+
+    def __init__(self, db_path):
+        super().__init__(db_path)
+        conn = self._connect()
+        had_token_counts = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'token_counts'").fetchone()
+        conn.executescript(self.SCHEMA)
+        # Databases created before the summary columns existed
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(conversations)")}
+        if "last_activity" not in columns:
+            conn.executescript("""
+                ALTER TABLE conversations ADD COLUMN last_activity TEXT;
+                ALTER TABLE conversations ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0;
+                ALTER TABLE conversations ADD COLUMN total_tokens INTEGER NOT NULL DEFAULT 0;
+            """)
+        if "version" not in columns:
+            conn.execute("ALTER TABLE conversations ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        if "last_activity" not in columns or not had_token_counts:
+            self.rebuild_summaries()
+
+    def create_conversation(self, conv_id, header):
+        self._connect().execute(
+            "INSERT INTO conversations (conv_id, title, created_at, header, last_activity) VALUES (?, ?, ?, ?, ?)",
+            (conv_id, header["title"], header["created_at"], json.dumps(header, ensure_ascii=False),
+             header["created_at"])
+        )
+
+    def append_messages(self, conv_id, messages):
+        with self._transaction() as conn:
+            return self._insert_messages(conn, conv_id, messages)
+
+    def _insert_messages(self, conn, conv_id, messages):
+        # Returns (version before, version after); the write lock makes the pair exact
+        version = conn.execute("SELECT version FROM conversations WHERE conv_id = ?", (conv_id,)).fetchone()[0]
+        next_idx = conn.execute(
+            "SELECT COALESCE(MAX(idx) + 1, 0) FROM messages WHERE conv_id = ?", (conv_id,)
+        ).fetchone()[0]
+        conn.executemany(
+            "INSERT INTO messages (conv_id, idx, sender, ai_service, model, tokens, created_at, data) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(conv_id, next_idx + offset, message.get("sender"), message.get("ai_service"),
+              message.get("model"), message.get("tokens") or 0, message.get("timestamp"),
+              json.dumps(message, ensure_ascii=False))
+             for offset, message in enumerate(messages)]
+        )
+        conn.execute(
+            "UPDATE conversations SET message_count = message_count + ?, total_tokens = total_tokens + ?, "
+            "last_activity = COALESCE(?, last_activity), version = version + 1 WHERE conv_id = ?",
+            (len(messages), sum(tokens for message in messages for _, tokens in _token_counts(message)),
+             messages[-1].get("timestamp") if messages else None, conv_id)
+        )
+
+        token_counts = {}
+        for message in messages:
+            for keys, tokens in _token_counts(message):
+                token_counts[keys] = token_counts.get(keys, 0) + tokens
+        conn.executemany(
+            "INSERT INTO token_counts (conv_id, ai_service, model, sender, tokens) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (conv_id, ai_service, model, sender) DO UPDATE SET tokens = tokens + excluded.tokens",
+            [(conv_id, *key, tokens) for key, tokens in token_counts.items()]
+        )
+        return (version, version + 1)
+
+    def load_conversation(self, conv_id):
+        conn = self._connect()
+        row = conn.execute("SELECT header FROM conversations WHERE conv_id = ?", (conv_id,)).fetchone()
+        if row is None:
+            raise KeyError(f"Unknown conversation: {conv_id}")
+        conversation = json.loads(row[0])
+        conversation["messages"] = [
+            json.loads(data) for (data,) in
+            conn.execute("SELECT data FROM messages WHERE conv_id = ? ORDER BY idx", (conv_id,))
+        ]
+        return conversation
+
+    def iter_messages(self, conv_id):
+        for (data,) in self._connect().execute("SELECT data FROM messages WHERE conv_id = ? ORDER BY idx", (conv_id,)):
+            yield json.loads(data)
+
+    def load_tail(self, conv_id, count):
+        # Message idx values run 0..n-1, so the smallest one fetched is the window's offset
+        rows = self._connect().execute(
+            "SELECT idx, data FROM messages WHERE conv_id = ? ORDER BY idx DESC LIMIT ?", (conv_id, count)
+        ).fetchall()
+        if not rows:
+            return [], self.get_summary(conv_id)["message_count"]
+        return [json.loads(data) for _, data in reversed(rows)], rows[-1][0]
+
+    def conversation_version(self, conv_id):
+        row = self._connect().execute("SELECT version FROM conversations WHERE conv_id = ?", (conv_id,)).fetchone()
+        return row[0] if row else None
+
+    def rewrite_conversation(self, conv_id, conversation):
+        # Full rewrite for maintenance jobs such as migrations; normal writes only append
+        header = {key: value for key, value in conversation.items() if key != "messages"}
+        with self._transaction() as conn:
+            conn.execute("UPDATE conversations SET header = ?, message_count = 0, total_tokens = 0 WHERE conv_id = ?",
+                         (json.dumps(header, ensure_ascii=False), conv_id))
+            conn.execute("DELETE FROM messages WHERE conv_id = ?", (conv_id,))
+            conn.execute("DELETE FROM token_counts WHERE conv_id = ?", (conv_id,))
+            self._insert_messages(conn, conv_id, conversation["messages"])
+
+    def list_conversations(self):
+        return [conv_id for (conv_id,) in
+                self._connect().execute("SELECT conv_id FROM conversations ORDER BY created_at DESC")]
+
+    def list_conversation_summaries(self):
+        rows = self._connect().execute(
+            "SELECT conv_id, title, created_at, last_activity, message_count, total_tokens "
+            "FROM conversations ORDER BY created_at DESC"
+        )
+        return [
+            {"conv_id": conv_id, "title": title, "created_at": created_at, "last_activity": last_activity,
+             "message_count": message_count, "total_tokens": total_tokens}
+            for conv_id, title, created_at, last_activity, message_count, total_tokens in rows
+        ]
+
+    def get_summary(self, conv_id):
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT title, created_at, last_activity, message_count, total_tokens FROM conversations WHERE conv_id = ?",
+            (conv_id,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(f"Unknown conversation: {conv_id}")
+        title, created_at, last_activity, message_count, total_tokens = row
+
+        rollups = {"by_service": {}, "by_model": {}, "by_sender": {}}
+        for ai_service, model, sender, tokens in conn.execute(
+                "SELECT ai_service, model, sender, tokens FROM token_counts WHERE conv_id = ?", (conv_id,)):
+            for dimension, key in zip(ROLLUP_DIMENSIONS, (ai_service, model, sender)):
+                rollups[dimension][key] = rollups[dimension].get(key, 0) + tokens
+        return {"conv_id": conv_id, "title": title, "created_at": created_at, "last_activity": last_activity,
+                "message_count": message_count, "total_tokens": total_tokens, "token_rollups": rollups}
+
+    def rebuild_summaries(self):
+        # Recomputes every summary and token rollup from the messages table
+        with self._transaction() as conn:
+            conn.execute("""
+                UPDATE conversations SET
+                    last_activity = COALESCE((SELECT MAX(created_at) FROM messages m
+                                              WHERE m.conv_id = conversations.conv_id), created_at),
+                    message_count = (SELECT COUNT(*) FROM messages m WHERE m.conv_id = conversations.conv_id),
+                    total_tokens = (SELECT COALESCE(SUM(tokens + COALESCE(json_extract(data, '$.tokens_in'), 0)), 0)
+                                    FROM messages m WHERE m.conv_id = conversations.conv_id)
+            """)
+            conn.execute("DELETE FROM token_counts")
+            conn.execute("""
+                INSERT INTO token_counts (conv_id, ai_service, model, sender, tokens)
+                    SELECT conv_id, ai_service, model, sender, SUM(tokens) FROM (
+                        SELECT conv_id, COALESCE(ai_service, 'none') AS ai_service, COALESCE(model, 'none') AS model,
+                               COALESCE(sender, 'none') AS sender, tokens
+                        FROM messages
+                        UNION ALL
+                        SELECT conv_id, COALESCE(ai_service, 'none'), COALESCE(model, 'none'), 'user',
+                               json_extract(data, '$.tokens_in')
+                        FROM messages WHERE json_extract(data, '$.tokens_in') > 0
+                    ) GROUP BY 1, 2, 3, 4
+            """)
+            return conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+
+
+ROLLUP_DIMENSIONS = ("by_service", "by_model", "by_sender")
+
+
+def _token_counts(message):
+    # Token rollup entries for a message as ((ai_service, model, sender), tokens); unset fields
+    # (e.g. the model of a plain user message) count as "none". A board-room reply also
+    # carries the input its model used as tokens_in, which is counted on the user's side of
+    # that model's exchange, the way send_to_* records it on the user message.
+    ai_service = message.get("ai_service") or "none"
+    model = message.get("model") or "none"
+    counts = [((ai_service, model, message.get("sender") or "none"), message.get("tokens") or 0)]
+    if message.get("tokens_in"):
+        counts.append(((ai_service, model, "user"), message["tokens_in"]))
+    return counts
+
+
+def create_storage(backend, history_dir):
+    if backend == "sqlite":
+        return SQLiteStorage(Path(history_dir) / "conversations.db")
+    if backend == "file":
+        return FileStorage(history_dir)
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+def copy_conversations(source, target):
+    # Copies histories between backends, e.g. before switching CHAT_STORAGE from "file" to
+    # "sqlite" (see maintenance.py copy-storage). Conversations the target already holds are
+    # left alone, so an interrupted copy can simply be run again.
+    existing = set(target.list_conversations())
+    copied = 0
+    for conv_id in source.list_conversations():
+        if conv_id in existing:
+            continue
+        conversation = source.load_conversation(conv_id)
+        messages = conversation.pop("messages")
+        target.create_conversation(conv_id, conversation)
+        if messages:
+            target.append_messages(conv_id, messages)
+        copied += 1
+    return copied
@@ -0,0 +1,79 @@
+import io
+import os
+import threading
+from collections import OrderedDict
+
+from startup_timing import timed
+
+
+class ThumbnailCache:
+    # Small JPEG previews of blob-store images for the chat stream, so a thread with dozens
+    # of 1024x1024 images never decodes or ships them at full size. Thumbnails are written
+    # next to the blobs (blobs/thumbs/ab/abcdef....jpg) when an image is stored, or on first
+    # view for older ones, and the most recently shown are kept in memory in an LRU keyed by
+    # blob hash and bounded by total bytes.
+
+    MAX_DIMENSION = 320
+    MEMORY_BYTES = 16 * 1024 * 1024
+
+    def __init__(self, blob_store, max_dimension=None, memory_bytes=None):
+        self.blob_store = blob_store
+        self.root = blob_store.root / "thumbs"
+        self.root.mkdir(exist_ok=True)
+        self.max_dimension = max_dimension or self.MAX_DIMENSION
+        self.memory_bytes = memory_bytes or self.MEMORY_BYTES
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.Lock()
+
+    def get(self, blob_hash):
+        # Thumbnail bytes for a stored blob, generating and saving it if needed
+        with self._lock:
+            if blob_hash in self._memory:
+                self._memory.move_to_end(blob_hash)
+                return self._memory[blob_hash]
+
+        path = self.path(blob_hash)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = self.generate(blob_hash)
+        self._remember(blob_hash, data)
+        return data
+
+    def generate(self, blob_hash):
+        with timed("import PIL"):
+            from PIL import Image
+
+        with Image.open(self.blob_store.path(blob_hash)) as image:
+            image.thumbnail((self.max_dimension, self.max_dimension))
+            if image.mode != "RGB":
+                # JPEG has no alpha; flatten transparent screenshots onto white
+                rgba = image.convert("RGBA")
+                image = Image.new("RGB", rgba.size, "white")
+                image.paste(rgba, mask=rgba.getchannel("A"))
+            buffer = io.BytesIO()
+            image.save(buffer, "JPEG", quality=85)
+        data = buffer.getvalue()
+
+        path = self.path(blob_hash)
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return data
+
+    def path(self, blob_hash):
+        return self.root / blob_hash[:2] / f"{blob_hash}.jpg"
+
+    def _remember(self, blob_hash, data):
+        with self._lock:
+            if blob_hash in self._memory:
+                return
+            self._memory[blob_hash] = data
+            self._memory_size += len(data)
+            while self._memory_size > self.memory_bytes and len(self._memory) > 1:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_size -= len(evicted)
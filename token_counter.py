@@ -0,0 +1,83 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+from startup_timing import timed
+
+
+class TokenizerRegistry:
+    # Token counting per model. OpenAI models use the tiktoken encoding tiktoken maps them
+    # to; Claude, Gemini and DALL-E have no local tokenizer, so they fall back to cl100k_base
+    # as an estimate (provider-reported usage is preferred wherever a response includes it).
+    # Counts are memoized in a bounded LRU keyed by encoding and a hash of the text, so the
+    # repeated system prompt and context lines are only ever encoded once.
+
+    DEFAULT_ENCODING = "cl100k_base"
+    MEMO_SIZE = 8192
+
+    def __init__(self):
+        self._encodings = {}
+        self._encoding_names = {}
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+
+    def encoding_name(self, model=None):
+        if model not in self._encoding_names:
+            import tiktoken
+            try:
+                name = tiktoken.encoding_name_for_model(model) if model else self.DEFAULT_ENCODING
+            except KeyError:
+                name = self.DEFAULT_ENCODING
+            self._encoding_names[model] = name
+        return self._encoding_names[model]
+
+    def encoding(self, model=None):
+        name = self.encoding_name(model)
+        if name not in self._encodings:
+            with self._lock:
+                if name not in self._encodings:
+                    with timed("import tiktoken"):
+                        import tiktoken
+                    with timed(f"load {name} encoder"):
+                        self._encodings[name] = tiktoken.get_encoding(name)
+        return self._encodings[name]
+
+    def count(self, text, model=None):
+        encoding = self.encoding(model)
+        key = self._memo_key(encoding.name, text)
+        with self._lock:
+            if key in self._memo:
+                self._memo.move_to_end(key)
+                return self._memo[key]
+        tokens = len(encoding.encode(text, disallowed_special=()))
+        self._remember(key, tokens)
+        return tokens
+
+    def count_batch(self, texts, model=None, num_threads=8):
+        # Bulk counting: memo hits are answered directly and the rest go through tiktoken's
+        # encode_batch, which spreads the encoding over a thread pool
+        encoding = self.encoding(model)
+        keys = [self._memo_key(encoding.name, text) for text in texts]
+        counts = [None] * len(texts)
+        with self._lock:
+            for i, key in enumerate(keys):
+                if key in self._memo:
+                    counts[i] = self._memo[key]
+        missing = [i for i, tokens in enumerate(counts) if tokens is None]
+        if missing:
+            encoded = encoding.encode_batch([texts[i] for i in missing], num_threads=num_threads,
+                                            disallowed_special=())
+            for i, tokens in zip(missing, encoded):
+                counts[i] = len(tokens)
+                self._remember(keys[i], counts[i])
+        return counts
+
+    def _memo_key(self, encoding_name, text):
+        return encoding_name, hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+    def _remember(self, key, tokens):
+        with self._lock:
+            self._memo[key] = tokens
+            self._memo.move_to_end(key)
+            while len(self._memo) > self.MEMO_SIZE:
+                self._memo.popitem(last=False)